@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Color threshold calibration for ASABE 2016
+
+Searches the GREEN_* and ORANGE_* hue/saturation/value bounds and the
+erode/dilate iterations against labeled images, and writes the best found
+as a new config file along with a JSON report.
+
+An image is labeled by its file name prefix through CALIBRATE_LABELS, e.g.
+"SG" -> green, "SY" -> orange, "SB" -> neither; unlabeled images are
+skipped. A color counts as seen when BallFinder.detect, the full-frame
+detection the robot and server run (with the color lookup table if
+VISION_COLOR_LUT), finds a ball of that color. Each color is scored by the F1 of seen against
+labeled over the images, and the two colors are searched independently
+with CALIBRATE_TRIALS random trials around the current values. Trials run
+on a process pool; every worker decodes, resizes and blurs the images once
+and reuses them for all of its trials, as the blur does not depend on the
+calibrated settings.
+
+    python calibrate.py ../test/logitech-C270
+    python calibrate.py --trials 2000 --output settings-c270.json ../test/*
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import argparse
+import collections
+import glob
+import json
+import multiprocessing
+import os
+import random
+import time
+import cv2
+from vision import BallFinder
+
+# Constants
+COLORS = ['green', 'orange']
+KEYS = ['HUE_MIN', 'HUE_MAX', 'SAT_MIN', 'SAT_MAX', 'VAL_MIN', 'VAL_MAX', 'ERODE', 'DILATE']
+RADIUS_MIN = 4 # as in BallFinder.measure
+RADIUS_MAX = 40
+
+## Worker process state
+cache = {}
+
+# Settings
+class Settings(object):
+    """ The config as attributes, as BallFinder takes them from the Server or Robot """
+    def __init__(self, config):
+        for (key, value) in config.items():
+            setattr(self, key, value)
+        self.VERBOSE = False
+    def pretty_print(self, task, msg, *args, **fields):
+        pass
+
+## Load config
+def load_config(config_path):
+    """ Settings in file order, so the calibrated file reads like the original """
+    with open(config_path) as config_file:
+        return json.load(config_file, object_pairs_hook=collections.OrderedDict)
+
+## Label images
+def label_images(directories, labels):
+    """ [(path, color or None)] for every .jpg whose name starts with a label prefix """
+    images = []
+    for directory in directories:
+        for path in sorted(glob.glob(os.path.join(directory, '*.jpg'))):
+            name = os.path.basename(path)
+            for (prefix, color) in labels.items():
+                if name.startswith(prefix):
+                    images.append((path, color))
+                    break
+    return images
+
+## Worker initializer
+def init_worker(config, paths, size):
+    """ Decoded, resized and blurred once per worker, with one ball finder for all trials """
+    finder = BallFinder(Settings(config))
+    cache['finder'] = finder
+    cache['blurred'] = [finder.blur(cv2.resize(cv2.imread(path), size)) for path in paths]
+
+## Seen
+def seen(finder, blurred, color):
+    """ Whether the ball finder detects a ball of the color in the blurred image """
+    detected_balls = finder.detect(blurred, RADIUS_MIN, RADIUS_MAX, blurred=True)[2]
+    return any(ball[3] == color for ball in detected_balls)
+
+## Trial
+def trial(args):
+    """ Returns (color, trial number, params, [seen per image], seconds) """
+    (color, number, params) = args
+    finder = cache['finder']
+    for key in KEYS:
+        setattr(finder, '%s_%s' % (color.upper(), key), params[key])
+    start = time.time()
+    results = [seen(finder, blurred, color) for blurred in cache['blurred']]
+    return color, number, params, results, time.time() - start
+
+## Score
+def score(results, expected):
+    """ Precision, recall and F1 of seen against labeled """
+    tp = sum(1 for (r, e) in zip(results, expected) if r and e)
+    fp = sum(1 for (r, e) in zip(results, expected) if r and not e)
+    fn = sum(1 for (r, e) in zip(results, expected) if e and not r)
+    precision = tp / float(tp + fp) if tp + fp else 0.0
+    recall = tp / float(tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {'precision' : precision, 'recall' : recall, 'f1' : f1, 'tp' : tp, 'fp' : fp, 'fn' : fn}
+
+## Sample
+def sample(current, spread, rng):
+    """ Random parameters around the current ones, kept in range and ordered """
+    params = {}
+    for (key, maximum) in [('HUE', 179), ('SAT', 255), ('VAL', 255)]:
+        low = current[key + '_MIN'] + rng.randint(-spread[key], spread[key])
+        high = current[key + '_MAX'] + rng.randint(-spread[key], spread[key])
+        low = min(max(low, 0), maximum)
+        high = min(max(high, low), maximum)
+        params[key + '_MIN'] = low
+        params[key + '_MAX'] = high
+    params['ERODE'] = rng.randint(0, spread['MORPH'])
+    params['DILATE'] = rng.randint(0, spread['MORPH'])
+    return params
+
+## Calibrate
+def calibrate(config, images, trials, workers, seed):
+    """ Returns (best params and scores per color, trials per second) """
+    size = (config['CAMERA_WIDTH'], config['CAMERA_HEIGHT'])
+    spread = config['CALIBRATE_SPREAD']
+    rng = random.Random(seed)
+    jobs = []
+    for color in COLORS:
+        current = dict((key, config['%s_%s' % (color.upper(), key)]) for key in KEYS)
+        jobs.append((color, 0, current)) # trial 0 is the current settings
+        jobs.extend([(color, i + 1, sample(current, spread, rng)) for i in range(trials)])
+    pool = multiprocessing.Pool(workers, init_worker, (config, [path for (path, label) in images], size))
+    start = time.time()
+    best = {}
+    baseline = {}
+    try:
+        for (color, number, params, results, seconds) in pool.imap_unordered(trial, jobs, chunksize=16):
+            scores = score(results, [label == color for (path, label) in images])
+            if number == 0:
+                baseline[color] = scores
+            key = (scores['f1'], scores['precision'], -number) # ties go to the current settings
+            if (color not in best) or (key > best[color]['key']):
+                best[color] = {'key' : key, 'params' : params, 'scores' : scores, 'seconds' : seconds}
+    finally:
+        pool.terminate()
+    elapsed = time.time() - start
+    for color in COLORS:
+        best[color]['baseline'] = baseline[color]
+    return best, len(jobs) / elapsed if elapsed > 0 else 0.0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search the color thresholds against labeled images')
+    parser.add_argument('directories', nargs='+', help='image directories')
+    parser.add_argument('--config', default='settings.json')
+    parser.add_argument('--output', default='settings-calibrated.json', help='config file to write')
+    parser.add_argument('--report', help='JSON report to write (default: next to the output)')
+    parser.add_argument('--trials', type=int, help='trials per color (default: CALIBRATE_TRIALS)')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    config = load_config(options.config)
+    trials = options.trials or config['CALIBRATE_TRIALS']
+    images = label_images(options.directories, config['CALIBRATE_LABELS'])
+    if not images:
+        exit('No labeled images found')
+    print('Calibrating on %d labeled images, %d trials per color on %d workers ...' % (len(images), trials, options.workers))
+    (best, rate) = calibrate(config, images, trials, options.workers, options.seed)
+    report = {'images' : len(images), 'trials' : trials, 'trials_per_second' : rate, 'colors' : {}}
+    for color in COLORS:
+        for key in KEYS:
+            config['%s_%s' % (color.upper(), key)] = best[color]['params'][key]
+        report['colors'][color] = {
+            'params' : best[color]['params'],
+            'before' : best[color]['baseline'],
+            'after' : best[color]['scores'],
+            'seconds_per_image' : best[color]['seconds'] / len(images)
+        }
+        print('%s: precision %.2f -> %.2f, recall %.2f -> %.2f, %.2f ms per image' % (color,
+            best[color]['baseline']['precision'], best[color]['scores']['precision'],
+            best[color]['baseline']['recall'], best[color]['scores']['recall'],
+            1000 * report['colors'][color]['seconds_per_image']))
+    print('%.1f trials per second' % rate)
+    with open(options.output, 'w') as output:
+        json.dump(config, output, indent=4, separators=(',', ' : '))
+    with open(options.report or os.path.splitext(options.output)[0] + '-report.json', 'w') as output:
+        json.dump(report, output, indent=4, sort_keys=True)
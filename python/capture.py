@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Camera capture for the picker
+
+A background thread only grab()s frames, which keeps the camera's buffer
+drained without decoding anything. When the robot asks for a frame, the
+next grabbed frame is retrieve()d into one of a fixed pool of preallocated
+buffers and handed out with its sequence number and capture time.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import threading
+import time
+import numpy as np
+
+# Capture
+class Capture(object):
+
+    ## Initialize
+    def __init__(self, camera, width, height, pool_size=3, timeout=0.2):
+        """
+        camera : an opened cv2.VideoCapture (or anything with grab/retrieve)
+        pool_size : number of frame buffers; a returned frame stays valid
+                    until pool_size - 1 newer frames have been retrieved
+        timeout : longest latest() will wait for a new frame
+        """
+        self.camera = camera
+        self.timeout = timeout
+        self.pool = [np.zeros((height, width, 3), np.uint8) for i in range(pool_size)]
+        self.condition = threading.Condition()
+        self.slot = 0 # pool index of the latest retrieved frame
+        self.seq = 0 # sequence number of the latest retrieved frame
+        self.timestamp = 0.0 # capture time of the latest retrieved frame
+        self.grabbed = 0 # number of frames grabbed so far
+        self.wanted = 0 # number of callers waiting in latest()
+        self.ok = False # last grab succeeded
+        self.running = False
+
+    ## Start the capture thread
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    ## Stop the capture thread
+    def stop(self):
+        self.running = False
+
+    ## Capture loop
+    def run(self):
+        while self.running:
+            ok = self.camera.grab() # blocks until the next frame arrives
+            t = time.time()
+            with self.condition:
+                self.ok = ok
+                if not ok:
+                    self.condition.notify_all()
+                else:
+                    self.grabbed += 1
+                    if self.wanted > 0:
+                        self.retrieve(t)
+                        self.condition.notify_all()
+            if not ok:
+                time.sleep(0.01)
+
+    ## Decode the last grabbed frame into the next buffer
+    def retrieve(self, t):
+        slot = (self.slot + 1) % len(self.pool)
+        buf = self.pool[slot]
+        (s, frame) = self.camera.retrieve(buf)
+        if not s:
+            return
+        if frame is not buf:
+            if frame.shape == buf.shape:
+                np.copyto(buf, frame)
+            else:
+                self.pool[slot] = frame
+        self.slot = slot
+        self.seq = self.grabbed
+        self.timestamp = t
+
+    ## Freshest frame
+    def latest(self):
+        """
+        Returns (seq, timestamp, bgr) for the first frame grabbed after the
+        call, or the last retrieved frame if the camera is not delivering
+        (seq 0 means no frame has been captured yet, and the timestamp is now)
+        """
+        with self.condition:
+            if self.running and self.ok:
+                seq = self.seq
+                deadline = time.time() + self.timeout
+                self.wanted += 1
+                try:
+                    while (self.seq == seq) and self.ok and (time.time() < deadline):
+                        self.condition.wait(deadline - time.time())
+                finally:
+                    self.wanted -= 1
+            if self.seq == 0:
+                return 0, time.time(), self.pool[self.slot]
+            return self.seq, self.timestamp, self.pool[self.slot]
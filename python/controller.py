@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Serial link to the Pickup_ECU and Delivery_ECU sketches
+
+Commands are a letter with an optional integer value (e.g. F1000). The
+sketch replies with one status line as soon as the action finishes, e.g.
+    {'command':'F','result':0, 'line':0}
+The controller waits for that line with select() against a per-command
+deadline instead of sleeping for a fixed time.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import re
+import select
+import time
+
+# Constants
+STATUS_FIELD = re.compile(r"\s*'(\w+)'\s*:\s*(?:'(.)'|(-?\d+))\s*$")
+UNKNOWN_STATUS = {'command' : '?', 'result' : 255}
+PROBE_COMMAND = 'W' # answered by both sketches without moving anything
+
+## Parse status
+def parse_status(line):
+    """
+    Strict parser for the status lines printed by the sketches: a brace
+    delimited list of 'key':value pairs, where each value is either a
+    single quoted character or an integer. Raises ValueError otherwise.
+    """
+    line = line.strip()
+    if not (line.startswith('{') and line.endswith('}')):
+        raise ValueError('Not a status line')
+    status = {}
+    for field in line[1:-1].split(','):
+        match = STATUS_FIELD.match(field)
+        if match is None:
+            raise ValueError('Bad status field: %s' % field)
+        (key, char, number) = match.groups()
+        status[key] = char if char is not None else int(number)
+    if 'command' not in status:
+        raise ValueError('Status has no command')
+    return status
+
+## Identify a sketch
+def identify(status):
+    """ 'picker' or 'delivery' by the fields of a status line, or None """
+    if 'line' in status:
+        return 'picker'
+    elif ('left' in status) and ('center' in status) and ('right' in status):
+        return 'delivery'
+    return None
+
+# Controller
+class Controller(object):
+
+    ## Initialize
+    def __init__(self, port, deadlines, pretty_print):
+        """
+        port : an open serial.Serial
+        deadlines : seconds to wait per command letter, with a 'default';
+                    a command's value is taken as milliseconds and added
+        """
+        self.port = port
+        self.deadlines = deadlines
+        self.pretty_print = pretty_print
+        self.buffer = ''
+        self.latency = {} # command letter -> [count, total, max] in seconds
+
+    ## Deadline for a command
+    def deadline(self, action):
+        letter = action[0]
+        limit = self.deadlines.get(letter, self.deadlines['default'])
+        value = action[1:]
+        if value.isdigit():
+            limit += int(value) / 1000.0
+        return limit
+
+    ## Execute
+    def execute(self, action):
+        """
+        Sends the command and returns the parsed status as soon as the
+        sketch reports it. The status gets a 'latency' key in seconds.
+        On timeout the unknown status ('?', 255) is returned.
+        """
+        self.port.flushInput() # drop anything left over from a previous command
+        self.buffer = ''
+        start = time.time()
+        self.port.write(action)
+        status = self.read_status(action[0], start + self.deadline(action))
+        latency = time.time() - start
+        if status is None:
+            self.pretty_print('CTRL', 'Error: No status for %s after %.2fs' % (action, latency))
+            status = dict(UNKNOWN_STATUS)
+        status['latency'] = latency
+        self.record(action[0], latency)
+        return status
+
+    ## Probe
+    def probe(self, timeout):
+        """ Sends the probe command, returns which sketch answered within timeout or None """
+        self.port.flushInput()
+        self.buffer = ''
+        self.port.write(PROBE_COMMAND)
+        status = self.read_status(PROBE_COMMAND, time.time() + timeout)
+        if (status is None) or (status['command'] != PROBE_COMMAND):
+            return None
+        return identify(status)
+
+    ## Read status
+    def read_status(self, letter, deadline):
+        """ Reads lines until a status for the command (or '?') arrives """
+        while True:
+            while '\n' in self.buffer:
+                (line, self.buffer) = self.buffer.split('\n', 1)
+                if not line.strip():
+                    continue
+                try:
+                    status = parse_status(line)
+                except ValueError as e:
+                    self.pretty_print('CTRL', 'Error: %s (%s)' % (str(e), line.strip()))
+                    continue
+                if status['command'] in [letter, '?']:
+                    return status
+                self.pretty_print('CTRL', 'Discarding stale status: %s' % line.strip())
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            (readable, w, x) = select.select([self.port], [], [], remaining)
+            if readable:
+                self.buffer += self.port.read(max(self.port.inWaiting(), 1))
+
+    ## Latency statistics
+    def record(self, letter, latency):
+        stats = self.latency.setdefault(letter, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+    def report(self):
+        """ Per-command count, mean and max latency """
+        return dict((letter, {'count' : n, 'mean' : total / n, 'max' : worst}) for (letter, (n, total, worst)) in self.latency.items())
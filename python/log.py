@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Non-blocking log for the Robot and the Server
+
+pretty_print() only appends the record to a bounded ring buffer and a queue;
+a background thread formats it and writes it out, so a slow terminal (e.g.
+over SSH) never holds up the control loop. The message is %-formatted with
+its arguments by the writer, so arguments must not be changed after they
+are logged. Records below the level are dropped before anything is done
+with them, and the timestamp is only formatted once per second. The ring
+buffer keeps the last records, with their keyword fields, to be dumped as
+JSON lines on a crash.
+
+    log.pretty_print('ZMQ', 'Response: %s', response, robot='picker', seq=12)
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import atexit
+import collections
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+# Constants
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'DEBUG' : DEBUG, 'INFO' : INFO, 'WARNING' : WARNING, 'ERROR' : ERROR}
+NAMES = dict((level, name) for (name, level) in LEVELS.items())
+TIME_FORMAT = '%d/%b/%Y:%H:%M:%S'
+
+## Level of a record
+def level_of(task, msg):
+    """ For callers that do not give one: errors by their message, warnings by their task """
+    if (task == 'ERROR') or msg.startswith('Error'):
+        return ERROR
+    elif task in ['WARN', 'WARNING']:
+        return WARNING
+    return INFO
+
+## Format a message with its arguments
+def format_message(msg, args):
+    if not args:
+        return msg
+    try:
+        return msg % args
+    except (TypeError, ValueError):
+        return ' '.join([msg] + [str(arg) for arg in args])
+
+# Log
+class Log(object):
+
+    ## Initialize
+    def __init__(self, level='INFO', ring_size=1000, queue_size=1000, stream=None):
+        """
+        Usable before the settings are loaded, see configure()
+        stream : where the writer prints, stdout by default
+        """
+        self.level = LEVELS[level]
+        self.ring = collections.deque(maxlen=ring_size)
+        self.queue = Queue.Queue(queue_size)
+        self.stream = stream or sys.stdout
+        self.dropped = 0 # records not printed because the writer fell behind
+        self.second = None
+        self.stamp = ''
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    ## Configure from the settings
+    def configure(self, level, ring_size, queue_size):
+        self.level = LEVELS[level]
+        self.ring = collections.deque(self.ring, maxlen=ring_size)
+        with self.queue.mutex:
+            self.queue.maxsize = queue_size
+
+    ## Log a record
+    def pretty_print(self, task, msg, *args, **fields):
+        """
+        Keyword arguments are kept as structured fields for the crash dump,
+        except level, which defaults to level_of(task, msg)
+        """
+        level = fields.pop('level', None) or level_of(task, msg)
+        if level < self.level:
+            return
+        record = (time.time(), level, task, msg, args, fields)
+        self.ring.append(record)
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    ## Writer loop
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.stream.write(self.format(record) + '\n')
+                if self.queue.empty():
+                    self.stream.flush()
+            except Exception:
+                pass
+        self.stream.flush()
+
+    ## Format a record for printing
+    def format(self, record):
+        (t, level, task, msg, args, fields) = record
+        second = int(t)
+        if second != self.second:
+            self.second = second
+            self.stamp = time.strftime(TIME_FORMAT, time.localtime(second))
+        return '[%s] %s\t%s' % (self.stamp, task, format_message(msg, args))
+
+    ## Close
+    def close(self, timeout=1.0):
+        """ Prints what is queued, waiting at most timeout seconds """
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except Queue.Full:
+                return
+            self.thread.join(timeout)
+
+    ## Dump the ring buffer
+    def dump(self, path):
+        """ Writes the last records as JSON lines, oldest first """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as dump:
+            for (t, level, task, msg, args, fields) in list(self.ring):
+                entry = dict(fields)
+                entry.update({'time' : t, 'level' : NAMES[level], 'task' : task, 'message' : format_message(msg, args)})
+                dump.write(json.dumps(entry, default=str) + '\n')
+        return path
+
+    ## Dump on crash
+    def dump_on_crash(self, directory, name):
+        """ Dumps the ring buffer to directory/name-<time>.jsonl if an uncaught exception ends the process """
+        hook = sys.excepthook
+        def excepthook(kind, value, tb):
+            self.pretty_print('ERROR', 'Crashed: %s', ''.join(traceback.format_exception(kind, value, tb)))
+            self.crash_dump(directory, name)
+            hook(kind, value, tb)
+        sys.excepthook = excepthook
+    def crash_dump(self, directory, name):
+        path = os.path.join(directory, '%s-%s.jsonl' % (name, time.strftime('%Y%m%d-%H%M%S')))
+        try:
+            self.dump(path)
+        except Exception as error:
+            sys.stderr.write('Could not write %s: %s\n' % (path, str(error)))
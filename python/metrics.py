@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Timing metrics for the control loop
+
+Durations are recorded per stage (e.g. decide, vision, execute), robot and
+action letter. Each key keeps its last METRICS_WINDOW samples, from which
+the quantiles are computed on request, plus a running count and sum.
+Recording is one deque append, so it can sit on the hot path.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import collections
+import threading
+
+# Constants
+QUANTILES = [0.5, 0.95, 0.99]
+PROMETHEUS_NAME = 'asabe_stage_seconds'
+
+## Quantile of sorted samples
+def quantile(samples, q):
+    if not samples:
+        return 0.0
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+# Series
+class Series(object):
+    """ Rolling samples of one (stage, robot, action) """
+    def __init__(self, window):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+
+# Metrics
+class Metrics(object):
+
+    ## Initialize
+    def __init__(self, object):
+        """
+        Requires super-object to have the METRICS_WINDOW setting
+        """
+        self.METRICS_WINDOW = object.METRICS_WINDOW
+        self.series = {} # (stage, robot, action) -> Series
+        self.lock = threading.Lock() # only taken to add a series
+
+    ## Record
+    def record(self, stage, seconds, robot='server', action=''):
+        key = (stage, robot, action)
+        series = self.series.get(key)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(key, Series(self.METRICS_WINDOW))
+        series.add(seconds)
+
+    ## Record the timings a robot sent with its request
+    def record_robot(self, request):
+        """
+        request['timings'] is {stage: [seconds, action letter]}, measured
+        before this request; older robots send {stage: seconds}, which are
+        put under the request's last action
+        """
+        last_action = request.get('last_action', '')[:1]
+        for (stage, timing) in request.get('timings', {}).items():
+            if isinstance(timing, list):
+                (seconds, action) = timing
+            else:
+                (seconds, action) = (timing, last_action)
+            self.record(stage, seconds, request['robot'], action)
+
+    ## Summaries
+    def summary(self):
+        """ [{stage, robot, action, count, sum, mean, max, p50, p95, p99}] sorted by key """
+        summaries = []
+        for (key, series) in sorted(self.series.items()):
+            samples = sorted(series.samples)
+            (stage, robot, action) = key
+            summary = {
+                'stage' : stage,
+                'robot' : robot,
+                'action' : action,
+                'count' : series.count,
+                'sum' : series.sum,
+                'mean' : sum(samples) / len(samples) if samples else 0.0,
+                'max' : samples[-1] if samples else 0.0
+            }
+            for q in QUANTILES:
+                summary['p%d' % int(100 * q)] = quantile(samples, q)
+            summaries.append(summary)
+        return summaries
+
+    ## Prometheus text format
+    def prometheus(self):
+        lines = ['# HELP %s Time spent per stage of the control loop' % PROMETHEUS_NAME, '# TYPE %s summary' % PROMETHEUS_NAME]
+        for summary in self.summary():
+            labels = 'stage="%s",robot="%s",action="%s"' % (summary['stage'], summary['robot'], summary['action'])
+            for q in QUANTILES:
+                lines.append('%s{%s,quantile="%s"} %f' % (PROMETHEUS_NAME, labels, q, summary['p%d' % int(100 * q)]))
+            lines.append('%s_sum{%s} %f' % (PROMETHEUS_NAME, labels, summary['sum']))
+            lines.append('%s_count{%s} %d' % (PROMETHEUS_NAME, labels, summary['count']))
+        return '\n'.join(lines) + '\n'
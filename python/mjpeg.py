@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+MJPEG feeds for the Server's web interface
+
+Each feed holds the latest image published to it. An image is JPEG encoded
+at most once, the first time a viewer asks for it, and the same bytes are
+sent to every viewer.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import threading
+import cv2
+
+# Constants
+BOUNDARY = 'frame'
+CONTENT_TYPE = 'multipart/x-mixed-replace; boundary=%s' % BOUNDARY
+
+# Feed
+class Feed(object):
+
+    ## Initialize
+    def __init__(self, quality=80, timeout=1.0):
+        """
+        quality : JPEG quality of the encoded frames
+        timeout : how often waiting viewers check whether the feed was closed
+        """
+        self.quality = quality
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.key = None # identifies the published image, e.g. a frame generation
+        self.image = None
+        self.generation = 0 # bumped for every published image
+        self.jpeg = None
+        self.jpeg_generation = 0 # generation of the encoded jpeg
+        self.viewers = 0
+        self.open = True
+
+    ## Publish
+    def publish(self, key, image):
+        """ Offer a new image to the viewers, unless key is the image already published """
+        with self.condition:
+            if key == self.key:
+                return
+            self.key = key
+            self.image = image
+            self.generation += 1
+            self.condition.notify_all()
+
+    ## Close
+    def close(self):
+        with self.condition:
+            self.open = False
+            self.condition.notify_all()
+
+    ## Encoded frame
+    def encoded(self):
+        """ The JPEG of the current generation, encoding it if no viewer has yet """
+        with self.condition:
+            if self.jpeg_generation != self.generation:
+                (ok, jpeg) = cv2.imencode('.jpg', self.image, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+                if ok:
+                    self.jpeg = jpeg.tostring()
+                self.jpeg_generation = self.generation
+            return self.jpeg
+
+    ## Frames
+    def frames(self):
+        """ Multipart MJPEG body parts, one per new generation, until the feed is closed """
+        seen = 0
+        with self.condition:
+            self.viewers += 1
+        try:
+            while self.open:
+                with self.condition:
+                    while self.open and (self.generation == seen):
+                        self.condition.wait(self.timeout)
+                    seen = self.generation
+                jpeg = self.encoded()
+                if self.open and (jpeg is not None):
+                    yield '--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (BOUNDARY, len(jpeg), jpeg)
+        finally:
+            with self.condition:
+                self.viewers -= 1
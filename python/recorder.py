@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Session recorder for the Server
+
+Every request and the response sent for it are appended to the session's
+directory under CHERRYPY_DATA_DIR:
+    chunk-0000.bin : the frames, back to back
+    chunk-0000.jsonl : one record per line, with the frame's offset, length,
+                       shape and encoding in the .bin file
+A chunk is closed once its frames pass RECORDER_CHUNK_SIZE bytes, and the
+oldest chunks of all sessions are deleted to keep the data directory under
+RECORDER_BUDGET bytes. Records are queued to a writer thread, and dropped
+if it falls RECORDER_QUEUE_SIZE records behind, so recording never holds up
+a response.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import glob
+import json
+import mmap
+import os
+import Queue
+import threading
+import time
+import numpy as np
+import cv2
+
+# Constants
+ENCODING_RAW = 'raw'
+ENCODING_JPEG = 'jpeg'
+REQUEST_KEYS = ['robot', 'client', 'seq', 'last_action', 'speculative', 'commit', 'timestamp', 'frame_seq', 'received', 'detection', 'vision', 'timings', 'batch_seq', 'completed', 'dropped']
+
+## Chunk paths
+def chunk_path(directory, number, extension):
+    return os.path.join(directory, 'chunk-%04d.%s' % (number, extension))
+
+## Read a session
+def read_session(directory):
+    """
+    Yields (record, bgr) for every record of a session directory in the order
+    they were written; bgr is None for records without a frame. Raw frames
+    are read-only views of the memory-mapped chunk.
+    """
+    for index_path in sorted(glob.glob(os.path.join(directory, 'chunk-*.jsonl'))):
+        frames_path = index_path[:-len('jsonl')] + 'bin'
+        frames = None
+        if os.path.getsize(frames_path) > 0:
+            with open(frames_path, 'rb') as frames_file:
+                frames = mmap.mmap(frames_file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(index_path) as index:
+            for line in index:
+                record = json.loads(line)
+                bgr = None
+                if 'frame' in record:
+                    frame = record['frame']
+                    data = np.frombuffer(frames, np.uint8, frame['length'], frame['offset'])
+                    if frame['encoding'] == ENCODING_JPEG:
+                        bgr = cv2.imdecode(data, cv2.IMREAD_COLOR)
+                    else:
+                        bgr = data.view(frame['dtype']).reshape(frame['shape'])
+                yield record, bgr
+
+# Recorder
+class Recorder(object):
+
+    ## Initialize
+    def __init__(self, object):
+        """
+        Requires super-object to have the CHERRYPY_DATA_DIR, RECORDER_*
+        settings and a pretty_print() function
+        """
+        self.VERBOSE = object.VERBOSE
+        self.CHERRYPY_DATA_DIR = object.CHERRYPY_DATA_DIR
+        self.RECORDER_QUEUE_SIZE = object.RECORDER_QUEUE_SIZE
+        self.RECORDER_CHUNK_SIZE = object.RECORDER_CHUNK_SIZE
+        self.RECORDER_BUDGET = object.RECORDER_BUDGET
+        self.RECORDER_FRAME_ENCODING = object.RECORDER_FRAME_ENCODING
+        self.RECORDER_JPEG_QUALITY = object.RECORDER_JPEG_QUALITY
+        self.pretty_print = object.pretty_print
+        self.directory = self.make_directory(os.path.join(self.CHERRYPY_DATA_DIR, time.strftime('%Y%m%d-%H%M%S')))
+        self.chunks = sorted(glob.glob(os.path.join(self.CHERRYPY_DATA_DIR, '*', 'chunk-*.bin'))) # oldest first
+        self.used = sum(self.chunk_size(path) for path in self.chunks)
+        self.queue = Queue.Queue(self.RECORDER_QUEUE_SIZE)
+        self.recorded = 0
+        self.dropped = 0
+        self.number = -1
+        self.frames = None
+        self.index = None
+        self.open_chunk()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    ## Make the session directory
+    def make_directory(self, path):
+        """ Adds a _1, _2, ... suffix if a session already started in the same second (sorts after it) """
+        directory = path
+        number = 0
+        while True:
+            try:
+                os.makedirs(directory)
+                return directory
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+            number += 1
+            directory = '%s_%d' % (path, number)
+
+    ## Record (called from the server loop)
+    def record(self, request, response, state):
+        """ Queues one request/response pair, returns False if it had to be dropped """
+        try:
+            self.queue.put_nowait((request, response, state, time.time()))
+            return True
+        except Queue.Full:
+            self.dropped += 1
+            return False
+
+    ## Close
+    def close(self):
+        """ Writes out what is queued and closes the chunk """
+        self.queue.put(None)
+        self.thread.join()
+
+    ## Writer loop
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.write(*item)
+            except Exception as error:
+                self.pretty_print('RECORDER', 'Error: %s' % str(error))
+            if self.queue.empty():
+                self.frames.flush()
+                self.index.flush()
+        self.frames.close()
+        self.index.close()
+
+    ## Write one record
+    def write(self, request, response, state, sent):
+        record = dict((key, request[key]) for key in REQUEST_KEYS if key in request)
+        record['action'] = response.get('action') if response else None
+        if response and ('batch' in response):
+            record['batch'] = response['batch']
+        record['sent'] = sent
+        record['state'] = state
+        bgr = request.get('bgr')
+        if (bgr is not None) and not request.get('dropped', False): # the vision pool never looked at a dropped frame
+            record['frame'] = self.write_frame(np.asarray(bgr, np.uint8))
+        self.index.write(json.dumps(record) + '\n')
+        self.recorded += 1
+        if self.frames.tell() >= self.RECORDER_CHUNK_SIZE:
+            self.open_chunk()
+
+    ## Write a frame
+    def write_frame(self, bgr):
+        frame = {'chunk' : self.number, 'offset' : self.frames.tell(), 'shape' : bgr.shape, 'dtype' : str(bgr.dtype)}
+        if self.RECORDER_FRAME_ENCODING == ENCODING_JPEG:
+            (ok, jpeg) = cv2.imencode('.jpg', bgr, [int(cv2.IMWRITE_JPEG_QUALITY), self.RECORDER_JPEG_QUALITY])
+            data = jpeg.tostring()
+            frame['encoding'] = ENCODING_JPEG
+        else:
+            data = np.ascontiguousarray(bgr).data
+            frame['encoding'] = ENCODING_RAW
+        self.frames.write(data)
+        frame['length'] = self.frames.tell() - frame['offset']
+        return frame
+
+    ## Open the next chunk
+    def open_chunk(self):
+        if self.frames is not None:
+            self.frames.close()
+            self.index.close()
+            self.used += self.chunk_size(self.chunks[-1])
+        self.number += 1
+        path = chunk_path(self.directory, self.number, 'bin')
+        self.frames = open(path, 'wb')
+        self.index = open(chunk_path(self.directory, self.number, 'jsonl'), 'w')
+        self.chunks.append(path)
+        self.enforce_budget()
+
+    ## Keep under the disk budget
+    def enforce_budget(self):
+        """ Deletes the oldest closed chunks (and emptied sessions) until the rest fit with a full new chunk """
+        while (len(self.chunks) > 1) and (self.used + self.RECORDER_CHUNK_SIZE > self.RECORDER_BUDGET):
+            path = self.chunks.pop(0)
+            self.used -= self.chunk_size(path)
+            for extension in ['bin', 'jsonl']:
+                try:
+                    os.remove(path[:-len('bin')] + extension)
+                except OSError:
+                    pass
+            if self.VERBOSE: self.pretty_print('RECORDER', 'Deleted %s to stay under budget' % path)
+            session = os.path.dirname(path)
+            if (session != self.directory) and not os.listdir(session):
+                os.rmdir(session)
+
+    ## Size of a chunk on disk
+    def chunk_size(self, path):
+        size = 0
+        for extension in ['bin', 'jsonl']:
+            try:
+                size += os.path.getsize(path[:-len('bin')] + extension)
+            except OSError:
+                pass
+        return size
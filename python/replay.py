@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Replay for ASABE 2016
+
+Feeds recorded sessions (directories written by the recorder under
+CHERRYPY_DATA_DIR) or directories of camera images through the server's
+decide_action and find_ball, without ZMQ, the GUI or the session clock,
+as fast as the CPU allows. For sessions, the replayed actions are compared
+with the recorded ones.
+
+    python replay.py data/20160412-101500 ../test/logitech-525
+    python replay.py --workers 4 --json data/*
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+import cv2
+from server import Server
+from recorder import read_session, chunk_path
+from metrics import Metrics
+from log import Log
+
+# Constants
+IMAGE_INTERVAL = 0.1 # seconds between the frames of an image directory
+IMAGE_ACTION = 'F' # image directories are replayed as if the picker had just moved forward
+
+# Replay Server
+class ReplayServer(Server):
+
+    ## Initialize
+    def __init__(self, config_path, verbose=False):
+        """ Only the configuration, ball finder and state machine of the Server """
+        self.verbose = verbose
+        self.log = Log()
+        self.load_config(config_path)
+        self.VERBOSE = verbose
+        self.VISION_WORKERS = 0 # the frames are found inline, in order
+        self.timings = Metrics(self)
+        self.__init_vision__()
+        self.__init_statemachine__()
+        self.running = True
+    def pretty_print(self, task, msg, *args, **fields):
+        if self.verbose:
+            Server.pretty_print(self, task, msg, *args, **fields)
+
+    ## Replay a recorded session
+    def replay_session(self, directory):
+        """
+        Each request is decided from the state the recording had before it,
+        so one differing decision does not make all the later ones differ.
+        The first request of a session whose oldest chunks were rotated out
+        has no known state before it and is not compared. Frames the vision
+        pool dropped were never decided on, and are skipped.
+        Returns [(seq, robot, last_action, recorded action, replayed action)]
+        """
+        decisions = []
+        known = os.path.exists(chunk_path(directory, 0, 'jsonl'))
+        for (record, bgr) in read_session(directory):
+            if record.get('dropped', False):
+                continue
+            request = dict((key, record[key]) for key in ['robot', 'client', 'seq', 'last_action', 'speculative', 'commit', 'batch_seq', 'completed', 'timestamp', 'detection'] if key in record)
+            request['bgr'] = bgr
+            state = record.get('state', {})
+            self.running = state.get('running', True)
+            self.clock = state.get('clock', self.RUN_TIME)
+            self.commit_speculation(request)
+            self.commit_batch(request)
+            if request.get('speculative', False):
+                action = self.speculate(request)
+            else:
+                action = self.decide_action(request)
+                self.plan_batch(request, action) # held back for commit_batch, as live
+            recorded = record.get('action') if known else None
+            decisions.append((record.get('seq'), record['robot'], record['last_action'], recorded, action))
+            for key in self.STATE_KEYS:
+                if key in state:
+                    setattr(self, key, state[key])
+            known = True
+        return decisions
+
+    ## Replay an image directory
+    def replay_images(self, directory):
+        """ Every image is a picker frame, in file name order """
+        decisions = []
+        paths = sorted(glob.glob(os.path.join(directory, '*.jpg')))
+        for (i, path) in enumerate(paths):
+            bgr = cv2.resize(cv2.imread(path), (self.CAMERA_WIDTH, self.CAMERA_HEIGHT))
+            request = {'robot' : 'picker', 'seq' : i, 'last_action' : IMAGE_ACTION, 'timestamp' : i * IMAGE_INTERVAL, 'bgr' : bgr}
+            action = self.decide_action(request)
+            decisions.append((i, 'picker', IMAGE_ACTION, None, action))
+        return decisions
+
+## Replay one source
+def replay(args):
+    """ Replays a session or an image directory, returns its report """
+    (source, config_path, verbose) = args
+    server = ReplayServer(config_path, verbose)
+    start = time.time()
+    if glob.glob(os.path.join(source, 'chunk-*.jsonl')):
+        decisions = server.replay_session(source)
+    else:
+        decisions = server.replay_images(source)
+    seconds = time.time() - start
+    mismatches = [d for d in decisions if (d[3] is not None) and (d[3] != d[4])]
+    return {
+        'source' : source,
+        'decisions' : len(decisions),
+        'compared' : len([d for d in decisions if d[3] is not None]),
+        'mismatches' : mismatches,
+        'actions' : [d[4] for d in decisions],
+        'seconds' : seconds,
+        'fps' : len(decisions) / seconds if seconds > 0 else 0.0,
+        'timings' : server.timings.summary()
+    }
+
+## Report
+def report(results):
+    for result in results:
+        print('%s: %d decisions in %.2fs (%.1f fps), %d of %d differ from the recording' % (result['source'], result['decisions'], result['seconds'], result['fps'], len(result['mismatches']), result['compared']))
+        for (seq, robot, last_action, recorded, replayed) in result['mismatches']:
+            print('    seq %s %s after %s: recorded %s, replayed %s' % (seq, robot, last_action, recorded, replayed))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay sessions or image directories through the decision logic')
+    parser.add_argument('sources', nargs='+', help='session or image directories')
+    parser.add_argument('--config', default='settings.json')
+    parser.add_argument('--workers', type=int, default=1, help='sources replayed in parallel')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--verbose', action='store_true')
+    options = parser.parse_args()
+    jobs = [(source, options.config, options.verbose) for source in options.sources]
+    start = time.time()
+    if options.workers > 1:
+        results = multiprocessing.Pool(options.workers).map(replay, jobs)
+    else:
+        results = map(replay, jobs)
+    seconds = time.time() - start
+    if options.json:
+        print(json.dumps(results, indent=4))
+    else:
+        report(results)
+        decisions = sum(result['decisions'] for result in results)
+        print('Total: %d decisions in %.2fs (%.1f fps)' % (decisions, seconds, decisions / seconds))
+    exit(1 if any(result['mismatches'] for result in results) else 0)
@@ -6,22 +6,30 @@ __author__ = "Trevor Stanhope"
 __version__ = "0.1"
 
 # Libraries
+import time
+STARTED = time.time() # for the startup report
 import zmq
-import ast
+import glob
 import json
 import os
 import sys
-import time
 import numpy as np
-from datetime import datetime
 from serial import Serial, SerialException
-import cv2, cv
-import thread
 import socket
+import threading
+import transport
+from capture import Capture
+from controller import Controller
+from log import Log
+from simulator.arduino import Arduino
 
 # Constants
 CONFIG_PATH = 'settings.json' 
 ROBOT_TYPE = socket.gethostname().split('-')[0]
+UNANSWERED_KEYS = ['type', 'robot', 'client', 'last_action', 'seq', 'commit', 'batch_seq', 'completed']
+VISION_ACTIONS = ['F', 'L', 'R', 'C', 'E', 'B'] # the server needs a new picker frame after these, so never speculates on them
+if len(sys.argv) > 1:
+    ROBOT_TYPE = sys.argv[1] # e.g. to run both robots on one machine against the simulator
 
 # Robot
 class Robot:
@@ -30,7 +38,11 @@ class Robot:
     def __init__(self, config_path, robot_type):
         
         # Configuration
+        start = time.time()
+        self.log = Log() # until the settings are loaded
         self.load_config(config_path)
+        self.log.configure(self.LOG_LEVEL, self.LOG_RING_SIZE, self.LOG_QUEUE_SIZE)
+        self.log.dump_on_crash(self.LOG_DUMP_DIR, robot_type)
 
         # Type
     
@@ -41,22 +53,31 @@ class Robot:
             exit(1)
 
         # Initializers
+        self.startup = [('imports', start - STARTED), ('config', time.time() - start)]
         try:
-            self.init_zmq()
-            self.init_arduino()
-            self.init_cam() # only the picker has a camera
+            for (step, init) in [('zmq', self.init_zmq), ('arduino', self.init_arduino), ('camera', self.init_cam), ('vision', self.init_vision)]:
+                start = time.time()
+                init()
+                self.startup.append((step, time.time() - start))
         except:
             self.close()
 
     ## Close
     def close(self):
         self.pretty_print('WARN', 'Shutdown triggered!')
+        self.log.crash_dump(self.LOG_DUMP_DIR, self.robot_type)
+        if getattr(self, 'simulator', None) is not None:
+            self.simulator.stop()
+        try:
+            for (letter, stats) in sorted(self.controller.report().items()):
+                self.pretty_print('CTRL', '%s: %d commands, mean %.2fs, max %.2fs' % (letter, stats['count'], stats['mean'], stats['max']))
+        except AttributeError:
+            pass
         sys.exit()
     
     ## Pretty Print
-    def pretty_print(self, task, msg):
-        date = datetime.strftime(datetime.now(), '%d/%b/%Y:%H:%M:%S')
-        print('[%s] %s\t%s' % (date, task, msg))
+    def pretty_print(self, task, msg, *args, **fields):
+        self.log.pretty_print(task, msg, *args, **fields)
 
     ## Load Config File
     def load_config(self, config_path):
@@ -72,106 +93,292 @@ class Robot:
     def init_zmq(self):
         try:
             self.context = zmq.Context()
-            self.socket = self.context.socket(zmq.REQ)
-            self.socket.connect(self.ZMQ_ADDR)
             self.poller = zmq.Poller()
-            self.poller.register(self.socket, zmq.POLLIN)
+            self.socket = None
+            self.connect()
+            self.transport = transport.LEGACY # until the server advertises multipart
+            self.client = STARTED # tells this process's requests from those of an earlier run
+            self.request_seq = 0
+            self.unanswered = None # a request that ran out of retries, sent again with the same seq
+            self.commit = None # seq of a speculative decision to confirm with the next request
+            self.timings = {} # stage -> (seconds, action letter measured), sent to the server with the next request
+            self.send_frame = True # the server says which requests need a frame
+            self.prefetch_frame = True # as send_frame, for the prefetched action
+            self.batch = [] # actions the server planned after the last one
+            self.batch_seq = None
+            self.batch_deadline = None
+            self.completed = None # (seq, steps executed) of the last batch, reported with the next request
+            self.timings_lock = threading.Lock() # prefetch requests run alongside execute_action
         except Exception as e:
             self.pretty_print('ZMQ', 'Error: %s' % str(e))
             raise e
     
     ## Initialize Arduino
-    def init_arduino(self, wait=2.0, attempts=3):
+    def init_arduino(self):
+        """
+        Probes every port matching ARDUINO_DEV at once and keeps the first
+        whose sketch identifies as this robot's ECU; the others are closed.
+        With SIMULATOR_ARDUINO the emulator's pseudo-terminal is the only port.
+        """
         if self.VERBOSE: self.pretty_print("CTRL", "Initializing Arduino ...") 
-        for dev in self.ARDUINO_DEV:
-            for i in range(attempts):
-                try:
-                    self.arduino = Serial(dev + str(i), self.ARDUINO_BAUD, timeout=self.ARDUINO_TIMEOUT)
-                    time.sleep(wait)
-                    break
-                except Exception as e:
-                    self.pretty_print('CTRL', 'Error: %s' % str(e))
-    
+        self.arduino = None
+        self.controller = None
+        self.simulator = None
+        if self.SIMULATOR_ARDUINO:
+            self.simulator = Arduino(self.robot_type, self.SIMULATOR_DURATIONS[self.robot_type], self.SIMULATOR_SPEED).start()
+            self.pretty_print("CTRL", "Emulating the %s Arduino on %s" % (self.robot_type, self.simulator.port))
+            (paths, boot_time) = ([self.simulator.port], 0)
+        else:
+            paths = sorted(sum([glob.glob(dev + '*') for dev in self.ARDUINO_DEV], []))
+            boot_time = self.ARDUINO_BOOT_TIME
+        found = threading.Event()
+        lock = threading.Lock()
+        def probe(path):
+            result = self.probe_port(path, boot_time)
+            if result is None:
+                return
+            (robot_type, port, controller) = result
+            with lock:
+                if (robot_type == self.robot_type) and (self.controller is None):
+                    (self.arduino, self.controller) = (port, controller)
+                    self.pretty_print('CTRL', 'Found the %s ECU on %s' % (robot_type, path))
+                    found.set()
+                    return
+            port.close()
+        threads = [threading.Thread(target=probe, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while (not found.is_set()) and any(thread.is_alive() for thread in threads):
+            found.wait(0.05)
+        if self.controller is None:
+            self.pretty_print('CTRL', 'Error: No %s ECU found on %s' % (self.robot_type, ', '.join(paths) or 'any port'))
+    def probe_port(self, path, boot_time):
+        """ Returns (robot type, port, controller) for the sketch answering on path, or None """
+        try:
+            port = Serial(path, self.ARDUINO_BAUD, timeout=self.ARDUINO_TIMEOUT)
+        except Exception as e:
+            self.pretty_print('CTRL', 'Error: %s' % str(e))
+            return None
+        controller = Controller(port, self.ARDUINO_DEADLINES, self.pretty_print)
+        time.sleep(boot_time) # the board resets when the port is opened
+        deadline = time.time() + self.ARDUINO_PROBE_TIMEOUT
+        while time.time() < deadline:
+            robot_type = controller.probe(min(self.ARDUINO_PROBE_INTERVAL, max(deadline - time.time(), 0)))
+            if robot_type is not None:
+                if self.VERBOSE: self.pretty_print('CTRL', '%s answers as the %s ECU' % (path, robot_type))
+                return robot_type, port, controller
+        port.close()
+        return None
+
     ## Initialize camera
     def init_cam(self):
+        self.blank = np.zeros((self.CAMERA_HEIGHT, self.CAMERA_WIDTH, 3), np.uint8)
+        self.capture = None
+        if self.robot_type != 'picker':
+            return # only the picker has a camera
         if self.VERBOSE: self.pretty_print("CTRL", "Initializing Camera ...")
         try:
-            self.bgr = np.zeros((self.CAMERA_HEIGHT, self.CAMERA_WIDTH, 3))
-            self.camera = cv2.VideoCapture(self.CAMERA_INDEX)
+            import cv2, cv # takes seconds on the Pi, so only the picker imports OpenCV
+            from simulator.camera import FrameSource
+            if self.CAMERA_SOURCE:
+                self.pretty_print("CAM", "Serving frames from %s at %d fps" % (self.CAMERA_SOURCE, self.CAMERA_SOURCE_FPS))
+                self.camera = FrameSource(self.CAMERA_SOURCE, self.CAMERA_WIDTH, self.CAMERA_HEIGHT, self.CAMERA_SOURCE_FPS)
+            else:
+                self.camera = cv2.VideoCapture(self.CAMERA_INDEX)
             self.camera.set(cv.CV_CAP_PROP_FRAME_WIDTH, self.CAMERA_WIDTH)
             self.camera.set(cv.CV_CAP_PROP_FRAME_HEIGHT, self.CAMERA_HEIGHT)
             self.camera.set(cv.CV_CAP_PROP_SATURATION, self.CAMERA_SATURATION)
             self.camera.set(cv.CV_CAP_PROP_CONTRAST, self.CAMERA_CONTRAST)
             self.camera.set(cv.CV_CAP_PROP_BRIGHTNESS, self.CAMERA_BRIGHTNESS)
-            thread.start_new_thread(self.capture_image, ())
+            self.capture = Capture(self.camera, self.CAMERA_WIDTH, self.CAMERA_HEIGHT, self.CAMERA_POOL_SIZE, self.CAMERA_FRAME_TIMEOUT).start()
         except Exception as e:
             self.pretty_print('CAM', 'Error: %s' % str(e))
 
     ## Capture image
     def capture_image(self):
-        if self.VERBOSE: self.pretty_print("CTRL", "Capturing Image ...")
-        while True:
-            time.sleep(0.01)
-            (s, bgr) = self.camera.read()
-            if s:
-                self.bgr = bgr
-            else:
-                self.bgr = np.zeros((self.CAMERA_HEIGHT, self.CAMERA_WIDTH, 3))
-    
+        """ Freshest frame as (seq, timestamp, bgr) """
+        if self.capture is None:
+            return 0, time.time(), self.blank
+        return self.capture.latest()
+
+    ## Initialize on-robot vision
+    def init_vision(self):
+        self.finder = None
+        self.send_thumbnail = False
+        if self.VISION_ON_ROBOT and self.robot_type == 'picker':
+            if self.VERBOSE: self.pretty_print("CTRL", "Initializing Ball Finder ...")
+            from vision import BallFinder
+            self.finder = BallFinder(self)
+
     ## Send request to server
-    def request_action(self, status):
+    def request_action(self, status, speculative=False):
+        """
+        A speculative request asks for the action to follow status['command']
+        before it has finished executing, and carries no frame. Other requests
+        only carry one if the server asked for it with the last action.
+        """
         if self.VERBOSE: self.pretty_print('ZMQ', 'Requesting action from server ...')
+        (commit, completed) = (self.commit, self.completed)
+        response = None
         try:
             last_action = status['command']
-            bgr = self.bgr
-            request = {
-                'type' : 'request',
-                'robot': self.robot_type,
-                'last_action' : last_action,
-                'bgr' : bgr.tolist()
-            }
-            dump = json.dumps(request)
-            self.socket.send(dump)
-            if self.VERBOSE: self.pretty_print('ZMQ', 'Checking poller ...')
-            socks = dict(self.poller.poll(self.ZMQ_TIMEOUT))
-            if socks:
-                if socks.get(self.socket) == zmq.POLLIN:
-                    dump = self.socket.recv(zmq.NOBLOCK)
-                    response = json.loads(dump)
-                    self.pretty_print('ZMQ', 'Response: %s' % str(response))
-                    try:
-                        action = response['action']
-                        self.pretty_print('ZMQ', 'Action: %s' % str(action))
-                        return action
-                    except:
-                        return None
-                else:
-                    self.pretty_print('ZMQ', 'Error: Poll Timeout')
+            if speculative or (self.unanswered is None):
+                self.request_seq += 1
+                request = {
+                    'type' : 'request',
+                    'robot': self.robot_type,
+                    'client' : self.client,
+                    'last_action' : last_action,
+                    'seq' : self.request_seq
+                }
+            else:
+                request = dict((key, value) for (key, value) in self.unanswered.items() if key in UNANSWERED_KEYS)
+                last_action = request['last_action']
+            if self.commit is not None:
+                request['commit'] = self.commit # the speculative decision we executed
+                self.commit = None
+            if self.completed is not None:
+                (request['batch_seq'], request['completed']) = self.completed
+                self.completed = None
+            timings = self.take_timings()
+            if timings:
+                request['timings'] = timings
+            if (self.finder is not None) and (not speculative) and (last_action[:1] in ['G', 'O']):
+                self.finder.reset_tracks() # the next ball is a new target, whether or not this request carries a frame
+            if speculative:
+                request['speculative'] = True
+                start = time.time()
+                parts = transport.encode_request(request)
+            elif not self.send_frame:
+                start = time.time()
+                parts = transport.encode_request(request)
             else:
-                self.pretty_print('ZMQ', 'Error: Socket Timeout')
-                exit(1)
+                start = time.time()
+                (request['frame_seq'], request['timestamp'], bgr) = self.capture_image()
+                captured = time.time()
+                self.record_timing('capture', captured - start, last_action)
+                parts = self.encode_request(request, bgr)
+                start = captured
+            self.record_timing('serialize', time.time() - start, last_action)
+            response = self.exchange(parts, last_action, 0 if speculative else self.ZMQ_RETRIES) # a late speculation is of no use
+            if response is None:
+                if speculative:
+                    (self.commit, self.completed) = (commit, completed) # never delivered, the next request carries them
+                else:
+                    self.unanswered = request # the server may have decided it, so ask for that decision
+                return None
+            if not speculative:
+                self.unanswered = None
+            self.pretty_print('ZMQ', 'Response: %s', response, seq=request['seq'])
+            self.negotiate_transport(response)
+            self.send_thumbnail = response.get('thumbnail', False)
+            try:
+                action = response['action']
+                if speculative and (response.get('assumed') != last_action):
+                    return None
+                if speculative:
+                    self.prefetch_frame = response.get('frame', True)
+                else:
+                    self.send_frame = response.get('frame', True)
+                    self.batch = response.get('batch', [])
+                    self.batch_seq = request['seq']
+                    self.batch_deadline = time.time() + response.get('deadline', 0)
+                self.pretty_print('ZMQ', 'Action: %s', action)
+                return action
+            except:
+                return None
         except Exception as e:
+            self.pretty_print('ZMQ', 'Error: %s' % str(e))
+            if speculative and (response is None):
+                (self.commit, self.completed) = (commit, completed)
+            self.connect() # the socket may be stuck between send and receive
             return None
 
+    ## Connect
+    def connect(self):
+        """ A fresh REQ socket, as one that missed its reply cannot send again """
+        if self.socket is not None:
+            self.poller.unregister(self.socket)
+            self.socket.close()
+        self.socket = self.context.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.ZMQ_ADDR)
+        self.poller.register(self.socket, zmq.POLLIN)
+
+    ## Send a request and wait for the response
+    def exchange(self, parts, last_action, retries):
+        """
+        Returns the decoded response, or None if there was none after
+        retries retries. After each timeout the socket is recreated and
+        the same request (same seq) is sent again, waiting ZMQ_BACKOFF times
+        longer, up to ZMQ_TIMEOUT. The server answers a repeated seq with the
+        response it already decided, so nothing is decided twice.
+        """
+        timeout = self.ZMQ_RETRY_TIMEOUT
+        for attempt in range(retries + 1):
+            sent = time.time()
+            self.socket.send_multipart(parts, copy=False)
+            if self.VERBOSE: self.pretty_print('ZMQ', 'Checking poller ...')
+            socks = dict(self.poller.poll(int(timeout)))
+            if socks.get(self.socket) == zmq.POLLIN:
+                dump = self.socket.recv(zmq.NOBLOCK)
+                self.record_timing('round_trip', time.time() - sent, last_action)
+                return json.loads(dump)
+            self.pretty_print('ZMQ', 'Error: No response after %d ms (attempt %d of %d), reconnecting' % (timeout, attempt + 1, retries + 1))
+            self.connect()
+            timeout = min(timeout * self.ZMQ_BACKOFF, self.ZMQ_TIMEOUT)
+        return None
+
+    ## Encode a request with its frame, or with the on-robot detection
+    def encode_request(self, request, bgr):
+        if self.transport == transport.LEGACY:
+            return transport.encode_legacy_request(request, bgr)
+        elif self.finder is not None:
+            start = time.time()
+            heading, distance, color = self.finder.find_ball(np.array(bgr, np.uint8), request['timestamp'])
+            self.record_timing('vision', time.time() - start, request['last_action'])
+            request['detection'] = {
+                'heading' : heading,
+                'distance' : distance,
+                'color' : color
+            }
+            if self.send_thumbnail:
+                thumbnail = self.finder.thumbnail(self.VISION_THUMBNAIL_SIZE)
+                return transport.encode_request(request, thumbnail, transport.ENCODING_JPEG, self.ZMQ_JPEG_QUALITY)
+            else:
+                return transport.encode_request(request)
+        else:
+            return transport.encode_request(request, bgr, self.ZMQ_FRAME_ENCODING, self.ZMQ_JPEG_QUALITY)
+
+    ## Timings for the server's metrics
+    def record_timing(self, stage, seconds, action=''):
+        """ Tagged with the action measured, as a speculative request carries them before that action is confirmed """
+        with self.timings_lock:
+            self.timings[stage] = (seconds, action[:1])
+    def take_timings(self):
+        with self.timings_lock:
+            (timings, self.timings) = (self.timings, {})
+        return timings
+
+    ## Pick the request transport advertised by the server
+    def negotiate_transport(self, response):
+        transports = response.get('transports', [transport.LEGACY])
+        if (self.ZMQ_TRANSPORT == transport.MULTIPART) and (transport.MULTIPART in transports):
+            if self.transport != transport.MULTIPART:
+                self.pretty_print('ZMQ', 'Switching to multipart transport (%s)' % self.ZMQ_FRAME_ENCODING)
+            self.transport = transport.MULTIPART
+        else:
+            self.transport = transport.LEGACY
+
     ## Exectute robotic action
-    def execute_action(self, action, attempts=5, wait=2.0):
+    def execute_action(self, action):
         if self.VERBOSE: self.pretty_print('CTRL', 'Interacting with controller ...')
         try:
-            self.pretty_print("CTRL", "Command: %s" % str(action))
-            self.arduino.write(str(action)) # send command
-            time.sleep(wait)
-            status = None
-            while status == None:
-                try:
-                    string = self.arduino.readline()
-                    status = ast.literal_eval(string) # parse status response
-                except SyntaxError as e:
-                    self.pretty_print('CTRL', 'Error: %s (%s)' % (str(e), string))
-                    time.sleep(wait)
-                except ValueError as e:
-                    self.pretty_print('CTRL', 'Error: %s (%s)' % (str(e), string))
-                    time.sleep(wait)
-            self.pretty_print("CTRL", "Status: %s" % status)
+            self.pretty_print("CTRL", "Command: %s", action)
+            status = self.controller.execute(str(action))
+            self.pretty_print("CTRL", "Status: %s (%.2fs)", status, status['latency'], command=action)
+            self.record_timing('execute', status['latency'], action)
             self.last_action = action
             return status
         except Exception as e:
@@ -181,6 +388,71 @@ class Robot:
                 'result' : 255
             }
             return status
+
+    ## Execute the batch planned after the last action
+    def execute_batch(self, status):
+        """
+        Runs the actions the server sent with the last one, in order, and
+        returns the status of the last one executed. The batch is aborted
+        once an action does not report its own command with result 0 (e.g.
+        a timeout) or the session deadline passes. The next request reports
+        how many of the batched actions ran.
+        """
+        (batch, self.batch) = (self.batch, [])
+        start = time.time()
+        completed = 0
+        for action in batch:
+            if (status['command'] != self.last_action[0]) or (status.get('result') != 0) or (time.time() > self.batch_deadline):
+                self.pretty_print('RUN', 'Aborting batch after %d of %d actions' % (completed, len(batch)))
+                break
+            status = self.execute_action(action)
+            completed += 1
+        self.record_timing('batch', time.time() - start, batch[0])
+        self.completed = (self.batch_seq, completed)
+        return status
+
+    ## Prefetch the next action while the current one executes
+    def start_prefetch(self, action):
+        """
+        Sends a speculative request in a worker thread, assuming the action
+        will complete. The ZMQ socket is only used by the worker until
+        finish_prefetch() joins it.
+        """
+        if (not self.PIPELINE_PREFETCH) or (self.transport != transport.MULTIPART) or self.batch:
+            return None
+        if (self.robot_type == 'picker') and (action[0] in VISION_ACTIONS):
+            return None # the server would answer None, as it needs the frame taken after the action
+        prefetch = {'assumed' : action[0]}
+        def worker():
+            prefetch['action'] = self.request_action({'command' : action[0]}, speculative=True)
+            prefetch['seq'] = self.request_seq
+        prefetch['thread'] = threading.Thread(target=worker)
+        prefetch['thread'].start()
+        return prefetch
+    def finish_prefetch(self, prefetch, status):
+        """ The prefetched action, if it was decided for the status we actually got """
+        if prefetch is None:
+            return None
+        prefetch['thread'].join()
+        action = prefetch.get('action')
+        if action and (status['command'] == prefetch['assumed']):
+            self.pretty_print('RUN', 'Using prefetched action: %s', action)
+            self.commit = prefetch['seq']
+            self.send_frame = self.prefetch_frame
+            if (self.finder is not None) and (prefetch['assumed'] in ['G', 'O']):
+                self.finder.reset_tracks() # no request follows the grab to reset them
+            return action
+        return None
+
+    ## Startup report
+    def report_startup(self):
+        """ Time per startup step and from launch to the first action, also sent to the server """
+        total = time.time() - STARTED
+        steps = ', '.join(['%s %.2fs' % step for step in self.startup])
+        self.pretty_print('BOOT', 'First action %.2fs after launch (%s)' % (total, steps))
+        self.record_timing('startup', total)
+        self.startup = None
+
     ## Run
     def run(self):
         status = {
@@ -190,11 +462,19 @@ class Robot:
         action = None
         while True:
             try:
-                action = self.request_action(status)
+                if not action:
+                    action = self.request_action(status)
+                    if action and (self.startup is not None):
+                        self.report_startup()
                 if action:
+                    prefetch = self.start_prefetch(action)
                     status = self.execute_action(action) #!TODO handle different responses
+                    if self.batch:
+                        status = self.execute_batch(status)
+                    action = self.finish_prefetch(prefetch, status)
             except Exception as e:
                 self.pretty_print('RUN', 'Error: %s' % str(e))
+                action = None
 
 if __name__ == '__main__':
     robot = Robot(CONFIG_PATH, ROBOT_TYPE)
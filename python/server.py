@@ -15,18 +15,29 @@ import cherrypy
 import os
 import sys
 import numpy as np
-from datetime import datetime, timedelta
 from cherrypy.process.plugins import Monitor
 from cherrypy import tools
 from bson import json_util
 import zmq
-import cv2, cv
-import pygtk
-pygtk.require('2.0')
-import gtk
+import cv2
+try:
+    import pygtk
+    pygtk.require('2.0')
+    import gtk
+except ImportError:
+    gtk = None # headless only
 import matplotlib.pyplot as mpl
 import time
+import threading
+import collections
 from random import randint
+import transport
+from vision import BallFinder
+from vision_pool import VisionPool
+import mjpeg
+from recorder import Recorder
+from metrics import Metrics
+from log import Log
 
 # Configuration
 try:
@@ -37,24 +48,36 @@ except Exception as err:
 
 # CherryPy3 server
 class Server:
+
+    VISION_ACTIONS = ['F', 'L', 'R', 'C', 'E', 'B'] # picker decisions made on a fresh frame
+    STATE_KEYS = ['orange_balls_collected', 'green_balls_collected', 'last_value', 'last_color', 'transfer_complete']
     
     ### Initialize ###
     def __init__(self, config_path):
         
         # Configuration
+        self.log = Log() # until the settings are loaded
         self.load_config(config_path)
+        self.log.configure(self.LOG_LEVEL, self.LOG_RING_SIZE, self.LOG_QUEUE_SIZE)
+        self.log.dump_on_crash(self.LOG_DUMP_DIR, 'server')
         
         # Initializers
+        self.timings = Metrics(self) # stage timings, served at /metrics
         self.__init_zmq__()
+        self.__init_vision__()
         self.__init_tasks__()
         self.__init_statemachine__()
-        self.__init_gui__()
+        self.__init_streams__()
+        self.__init_recorder__()
+        if self.GUI_HEADLESS or (gtk is None):
+            self.gui = None
+        else:
+            self.__init_gui__()
 
     ### Useful Functions ###
-    def pretty_print(self, task, msg):
-        """ Pretty Print """ 
-        date = datetime.strftime(datetime.now(), '%d/%b/%Y:%H:%M:%S')
-        print('[%s] %s\t%s' % (date, task, msg))
+    def pretty_print(self, task, msg, *args, **fields):
+        """ Pretty Print, see Log.pretty_print """
+        self.log.pretty_print(task, msg, *args, **fields)
     def load_config(self, config_path):
         """ Load Configuration """
         self.pretty_print('CONFIG', 'Loading Config File')
@@ -71,37 +94,55 @@ class Server:
         if self.VERBOSE: self.pretty_print('ZMQ', 'Initializing ZMQ')
         try:
             self.context = zmq.Context()
-            self.socket = self.context.socket(zmq.REP)
+            self.socket = self.context.socket(zmq.ROUTER) # REQ robots, answered in any order
             self.socket.bind(self.ZMQ_HOST)
+            self.queues = {} # robot -> deque of (envelope, request) waiting for a decision
+            self.stats = {} # robot -> queue depth and latency
+            self.replies = {} # (robot, client) -> its last request's id, response and envelopes, to answer retries
+            self.lock = threading.RLock() # the state machine is shared with the GUI thread
         except Exception as error:
             self.pretty_print('ZMQ', str(error))
     def receive_request(self):
+        """
+        Returns (envelope, request) for the next waiting message, or None.
+        The envelope is the ROUTER routing prefix needed to reply.
+        """
         if self.VERBOSE: self.pretty_print('ZMQ', 'Receiving request')
         try:
-            packet = self.socket.recv()
-            request = json.loads(packet)
-            return request
+            parts = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            return None
+        try:
+            start = time.time()
+            delimiter = [len(part) for part in parts].index(0) # len() of a Frame does not copy it
+            envelope = [part.bytes for part in parts[:delimiter + 1]]
+            request = transport.decode_request(parts[delimiter + 1:], self.wants_frame)
+            request['received'] = time.time()
+            self.timings.record('decode', request['received'] - start, request['robot'], request['last_action'][:1])
+            return envelope, request
         except Exception as error:
             self.pretty_print('ZMQ', 'Error: %s' % str(error))
-    def send_response(self, action):
-        """ Send Response """
+            return None
+    def send_response(self, envelope, action, **kwargs):
+        """ Send Response, any keyword arguments are added as fields """
         if self.VERBOSE: self.pretty_print('ZMQ', 'Sending Response to Robot')
         try:
             response = {
                 'type' : 'response',
-                'action' : action
+                'action' : action,
+                'transports' : [transport.MULTIPART, transport.LEGACY]
                 }
+            response.update(kwargs)
             dump = json.dumps(response)
-            self.socket.send(dump)
-            self.pretty_print('ZMQ', 'Response: %s' % str(response))
+            self.socket.send_multipart(envelope + [dump])
+            self.pretty_print('ZMQ', 'Response: %s', response)
             return response
         except Exception as error:
             self.pretty_print('ZMQ', str(error))   
     
     ### State-Machine Functions ###
     def __init_statemachine__(self):
-        self.bgr = cv2.imread(self.GUI_CAMERA_IMAGE)
-        self.mask = cv2.imread(self.GUI_MASK_IMAGE)
+        self.set_frame(cv2.imread(self.GUI_CAMERA_IMAGE), cv2.imread(self.GUI_MASK_IMAGE))
         self.running = False
         self.start_time = time.time()
         self.end_time = self.start_time + self.RUN_TIME
@@ -112,16 +153,80 @@ class Server:
         self.last_value = 0
         self.last_color = None
         self.transfer_complete = False
+        self.detections_received = 0
+        self.speculations = {} # (robot, client) -> (seq, state changes) of its last speculative decision
+        self.batches = {} # (robot, client) -> (seq, [state changes per step]) of its last batch
+    def commit_speculation(self, request):
+        """ Apply the state changes of a speculative decision the robot went on to execute """
+        pending = self.speculations.pop(self.client_key(request), None)
+        if (pending is not None) and (request.get('commit') == pending[0]):
+            if self.VERBOSE: self.pretty_print("DECIDE", "Committing speculative decision %d" % pending[0])
+            for (key, value) in pending[1].items():
+                setattr(self, key, value)
+    def commit_batch(self, request):
+        """ Apply the state changes of the batch steps the robot reports having executed """
+        pending = self.batches.pop(self.client_key(request), None)
+        if (pending is not None) and (request.get('batch_seq') == pending[0]):
+            completed = request.get('completed', 0)
+            if self.VERBOSE: self.pretty_print("DECIDE", "Committing %d of %d batched actions" % (completed, len(pending[1])))
+            for changes in pending[1][:completed]:
+                for (key, value) in changes.items():
+                    setattr(self, key, value)
+    def plan_batch(self, request, action):
+        """
+        The actions that follow action for certain, decided in order as if
+        each one before them completed, so the robot can run them without
+        asking again. Planning stops after an action not in BATCH_ACTIONS for
+        the robot, i.e. at the next real decision point. The state changes
+        of each step are held back until the robot reports how many steps it
+        executed (see commit_batch).
+        """
+        robot = request['robot']
+        if (not self.running) or (self.clock <= 0) or (action is None):
+            return []
+        before = dict((key, getattr(self, key)) for key in self.STATE_KEYS)
+        state = before
+        batch = []
+        steps = []
+        while (len(batch) < self.BATCH_MAX) and (action[:1] in self.BATCH_ACTIONS.get(robot, [])):
+            action = self.decide_action({'robot' : robot, 'last_action' : action[:1], 'seq' : request['seq']})
+            after = dict((key, getattr(self, key)) for key in self.STATE_KEYS)
+            steps.append(dict((key, value) for (key, value) in after.items() if value != state[key]))
+            state = after
+            batch.append(action)
+        for (key, value) in before.items():
+            setattr(self, key, value)
+        if batch:
+            self.batches[self.client_key(request)] = (request['seq'], steps)
+        return batch
+    def speculate(self, request):
+        """
+        Decide the next action assuming request['last_action'] completes, while
+        the robot is still executing it. Decisions that need a fresh frame
+        are not speculated (returns None). State changes are held back until
+        the robot confirms it executed the decision (see commit_speculation).
+        """
+        if (request['robot'] == 'picker') and (request['last_action'] in self.VISION_ACTIONS):
+            return None
+        before = dict((key, getattr(self, key)) for key in self.STATE_KEYS)
+        action = self.decide_action(request)
+        changes = {}
+        for key in self.STATE_KEYS:
+            if getattr(self, key) != before[key]:
+                changes[key] = getattr(self, key)
+                setattr(self, key, before[key])
+        self.speculations[self.client_key(request)] = (request['seq'], changes)
+        return action
     def decide_action(self, request):
         """
         Below is the Pseudocode for how the decisions are made:
         start()
         """
-        self.pretty_print("DECIDE", "Last Action: %s" % request['last_action'])
-        self.pretty_print("DECIDE", "Robot: %s" % request['robot'])
+        self.pretty_print("DECIDE", "Last Action: %s", request['last_action'], robot=request['robot'], seq=request.get('seq'))
+        self.pretty_print("DECIDE", "Robot: %s", request['robot'])
         
-        if request['robot'] == 'picker':
-            heading, distance, color = self.find_ball(np.array(request['bgr'], np.uint8))
+        if (request['robot'] == 'picker') and (request['last_action'] in self.VISION_ACTIONS):
+            heading, distance, color = self.get_detection(request)
 
         ## If paused
         if self.running == False:
@@ -138,7 +243,7 @@ class Server:
                 elif (request['last_action'] == 'F') or (request['last_action'] == 'L') or (request['last_action'] == 'R') or (request['last_action'] == 'C') or (request['last_action'] == 'E') or (request['last_action'] == 'B'):
                     if ((heading is not None) and (distance is not None) and (color is not None)):
                         self.last_color = color
-                        self.pretty_print("DECIDE", "Heading: %d, Distance: %d, Color: %s" % (heading, distance, color))
+                        self.pretty_print("DECIDE", "Heading: %d, Distance: %d, Color: %s", heading, distance, color, robot='picker', seq=request.get('seq'))
                         if distance <= self.TARGET_DISTANCE:
                             if color == 'green':
                                 action = 'G'
@@ -155,13 +260,23 @@ class Server:
                             action = 'F' + str(abs(distance))
                             self.last_value = abs(heading)
                     else:
-                        if (request['last_action'] == 'F') and (self.last_value > 0 and self.last_value <= 2000):
+                        coasting = (heading is not None) and (color is not None) # the tracker still expects the ball there
+                        if coasting and (heading < -self.ALIGNMENT_TOLERANCE):
+                            action = 'L' + str(abs(heading))
+                        elif coasting and (heading > self.ALIGNMENT_TOLERANCE):
+                            action = 'R' + str(abs(heading))
+                            self.last_value = abs(heading)
+                        elif (request['last_action'] == 'F') and (self.last_value > 0 and self.last_value <= 2000):
                             if self.last_color == 'green':
                                 action = 'G'
                                 self.green_balls_collected += 1
                             else:
                                 action = 'O'
                                 self.orange_balls_collected += 1
+                        elif coasting:
+                            self.pretty_print("DECIDE", "Heading: %d, Color: %s (coasting)", heading, color, robot='picker', seq=request.get('seq'))
+                            action = 'F' + str(self.TARGET_DISTANCE) # no distance without a detection, close in by the grab distance and look again
+                            self.last_value = abs(heading)
                         else:
                             self.pretty_print("DECIDE", "No ball detected! Backing up for safety!")
                             action = 'B500'
@@ -173,8 +288,6 @@ class Server:
                         action = "E"
                     else:
                         action = "C"
-                elif (self.orange_balls_collected + self.green_balls_collected == 8):
-                    action = 'S'
                 elif request['last_action'] == 'S':
                     action = 'A'
                 elif request['last_action'] == 'A':
@@ -184,6 +297,8 @@ class Server:
                 elif request['last_action'] == 'T':
                     self.transfer_complete = True
                     action = 'W'
+                elif (self.orange_balls_collected + self.green_balls_collected == 8):
+                    action = 'S'
                 elif request['last_action'] == '?':
                     action = '?'
                     self.pretty_print("WARNING", "Last action unknown! Check logs!")
@@ -227,141 +342,368 @@ class Server:
         else:
             self.pretty_print("DECIDE", "Time is up! Robots will wait!")
             action = 'W' # halt and wait at end
-        self.pretty_print("DECIDE", "Next Action: %s" % action)
+        if (request['robot'] == 'picker') and (action in ['G', 'O']):
+            self.finder.reset_tracks() # the next ball is a new target
+        self.pretty_print("DECIDE", "Next Action: %s", action, robot=request['robot'], seq=request.get('seq'))
         return action
 
     ### Computer Vision ###
-    def find_ball(self, bgr, RADIUS_MIN=4, RADIUS_MAX=40):
+    def __init_vision__(self):
+        if self.VERBOSE: self.pretty_print('CV2', 'Initializing Ball Finder ...')
+        self.finder = BallFinder(self)
+        self.frame = (0, None, None) # (generation, bgr, mask), the generation lets the GUI only redraw new frames
+        self.pool = None
+        if self.VISION_WORKERS > 0:
+            try:
+                self.pool = VisionPool(self)
+            except Exception as error:
+                self.pretty_print('CV2', 'Error: %s (finding balls in the server process)' % str(error))
+    def needs_pool(self, request):
+        """ Picker frames go to the worker pool, so the loop keeps serving the delivery robot """
+        return (self.pool is not None) and (request['robot'] == 'picker') and (request['last_action'] in self.VISION_ACTIONS) \
+            and ('detection' not in request) and (request.get('bgr') is not None) and self.pool.fits(request['bgr'])
+    def submit_vision(self, envelope, request):
+        t = request.get('timestamp') or request['received']
+        request['timestamp'] = t
+        request['submitted'] = time.time()
+        dropped = self.pool.submit((envelope, request), request['bgr'], self.finder.hints(t))
+        self.drop_vision(dropped)
+    def finish_vision(self):
+        """ Track the workers' detections here and answer the robot """
+        ((envelope, request), bgr, mask, detected_balls, dropped) = self.pool.finish()
+        with self.lock:
+            heading, distance, color = self.finder.select(bgr, mask, detected_balls, request['timestamp'])
+            self.set_frame(bgr, mask)
+            self.timings.record('vision', time.time() - request['submitted'], request['robot'], request['last_action'][:1])
+            request['vision'] = {'heading' : heading, 'distance' : distance, 'color' : color}
+            self.reply(envelope, request)
+        self.update_stats(request['robot'], request)
+        self.drop_vision(dropped)
+    def drop_vision(self, dropped):
         """
-        Find the contours for both masks, then use these
-        to compute the minimum enclosing circle and centroid
-        Returns:
-            color : green, yellow
-            pos: heading, distance, color
+        Frames dropped by the pool are not decided on, so the state machine
+        does not change: the robot gets no action and is asked for a fresh
+        frame, which it sends with the same last action. The recorder only
+        marks the drop, without the frame, and replay skips it.
         """
-        GREEN_LOWER = (self.GREEN_HUE_MIN, self.GREEN_SAT_MIN, self.GREEN_VAL_MIN)
-        GREEN_UPPER = (self.GREEN_HUE_MAX, self.GREEN_SAT_MAX, self.GREEN_VAL_MAX) 
-        ORANGE_LOWER = (self.ORANGE_HUE_MIN, self.ORANGE_SAT_MIN, self.ORANGE_VAL_MIN) 
-        ORANGE_UPPER = (self.ORANGE_HUE_MAX, self.ORANGE_SAT_MAX, self.ORANGE_VAL_MAX)
-
-        if self.VERBOSE: self.pretty_print("CV2", "Searching for ball ...")
-        blurred = cv2.GaussianBlur(bgr, (25, 25), 0)
-        hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
-        green_mask = cv2.inRange(hsv, GREEN_LOWER, GREEN_UPPER)
-        green_mask = cv2.erode(green_mask, None, iterations=2)
-        green_mask = cv2.dilate(green_mask, None, iterations=2)
-        orange_mask = cv2.inRange(hsv, ORANGE_LOWER, ORANGE_UPPER)
-        orange_mask = cv2.erode(orange_mask, None, iterations=4)
-        orange_mask = cv2.dilate(orange_mask, None, iterations=2)
-        orange_bgr = np.dstack((self.blank, orange_mask, orange_mask)) # set self.mask to be accessed by the GUI
-        green_bgr = np.dstack((self.blank, green_mask, self.blank)) # set self.mask to be accessed by the GUI
-        detected_balls = []
-        orange_circles = cv2.HoughCircles(orange_mask, cv.CV_HOUGH_GRADIENT, 4.0, 10)
-        green_circles = cv2.HoughCircles(green_mask, cv.CV_HOUGH_GRADIENT, 4.0, 10)
-        if orange_circles is not None:
-            orange_circles = np.round(orange_circles[0, :]).astype("int")
-        if green_circles is not None:
-            green_circles = np.round(green_circles[0, :]).astype("int")
- 
-        # Green Contours
-        green_contours = cv2.findContours(green_mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-        center = None # initialize the current (x, y) center of the ball
-        if len(green_contours) > 0: # only proceed if at least one contour was found
-            for c in green_contours:
-                ((x, y), radius) = cv2.minEnclosingCircle(c)
-                if (radius > RADIUS_MIN) and (radius < RADIUS_MAX): # only proceed if the radius meets a minimum size
-                    if green_circles is not None:
-                        for (x2,y2,r2) in green_circles:
-                            d = np.sqrt((x - x2)**2 + (y - y2)**2)
-                            if (d < 20) and (r2 > RADIUS_MIN) and (r2 < RADIUS_MAX):
-                                detected_balls.append((x,y,radius,'green'))
-                                cv2.circle(bgr, (int(x2), int(y2)), int(r2), (0, 255, 0), 2) 
-                    else:
-                        cv2.putText(green_bgr, 'X', (int(x)-10,int(y)+10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
-
-        # Orange Contours
-        orange_contours = cv2.findContours(orange_mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-        center = None # initialize the current (x, y) center of the ball
-        if len(orange_contours) > 0: # only proceed if at least one contour was found
-            for c in orange_contours:
-                ((x, y), radius) = cv2.minEnclosingCircle(c)
-                if (radius >= RADIUS_MIN) and (radius <= RADIUS_MAX): # only proceed if the radius meets a minimum size
-                    if orange_circles is not None:
-                        for (x2,y2,r2) in orange_circles:
-                            d = np.sqrt((x - x2)**2 + (y - y2)**2)
-                            if d < 20 and (r2 > RADIUS_MIN) and (r2 < RADIUS_MAX):
-                                detected_balls.append((x,y,r2,'orange'))
-                                cv2.circle(bgr, (int(x2), int(y2)), int(r2), (0, 255, 255), 2)
-                    else:
-                        cv2.putText(orange_bgr, 'X', (int(x)-10,int(y)+10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
-
-        # Draw
-        if len(detected_balls) > 0:
-            for x,y,r,color in detected_balls:
-                d = self.estimate_distance(y,r)
-                if color == 'green':
-                    cv2.putText(bgr, str(d), (int(x)+10, int(y)+10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
-                if color == 'orange':
-                    cv2.putText(bgr, str(d), (int(x)+10, int(y)+10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
-            x,y,r,c = max(detected_balls) # return the farthest to the right, use min() for left
-            cv2.circle(bgr, (int(x),int(y)), 3, (0, 0, 255), -1)
-            self.bgr = bgr # set BGR of GUI with the updated, drawn-on version
-            self.mask = orange_bgr + green_bgr
-            heading = self.estimate_heading(x)
-            distance = self.estimate_distance(y,r)
-            return heading, distance, color
-        else:
-            self.bgr = bgr
-            self.mask = orange_bgr + green_bgr
+        for (envelope, request) in dropped:
+            self.pretty_print('CV2', 'Dropping stale frame from %s' % request['robot'])
+            with self.lock:
+                try:
+                    response = self.send_response(envelope, None, seq=request.get('seq'), frame=True)
+                    self.remember(request, response)
+                    request['dropped'] = True
+                    self.record(request, response)
+                finally:
+                    self.forget(request)
+            self.update_stats(request['robot'], request)
+    def set_frame(self, bgr, mask):
+        """ Publish a new annotated frame and mask for the GUI, as one tuple so they are read together """
+        self.frame = (self.frame[0] + 1, bgr, mask)
+    def find_ball(self, bgr, t=None):
+        """ Run the ball finder on a full frame and keep its drawings for the GUI """
+        heading, distance, color = self.finder.find_ball(bgr, t)
+        self.set_frame(self.finder.bgr, self.finder.mask)
+        return heading, distance, color
+    def get_detection(self, request):
+        """
+        Pickers either upload a frame or run the ball finder themselves and
+        send only the detection, optionally with a small annotated thumbnail.
+        What the server found in a frame is kept as request['vision'].
+        """
+        if 'vision' in request: # found by the vision pool
+            vision = request['vision']
+            return vision['heading'], vision['distance'], vision['color']
+        elif 'detection' in request:
+            detection = request['detection']
+            if request.get('bgr') is not None:
+                bgr = np.array(request['bgr'], np.uint8)
+                self.set_frame(bgr, np.zeros_like(bgr))
+            return detection['heading'], detection['distance'], detection['color']
+        elif request.get('bgr') is None:
+            self.pretty_print('CV2', 'Error: No frame from %s after %s' % (request['robot'], request['last_action']))
             return None, None, None
-    def estimate_distance(self, y, r):
-        return self.DISTANCE_GAIN * int(2200 * r ** -1.7)
-    def estimate_heading(self, x): 
-        return self.HEADING_GAIN * int(x - self.CAMERA_WIDTH / 2)
+        else:
+            start = time.time()
+            heading, distance, color = self.find_ball(np.array(request['bgr'], np.uint8), request.get('timestamp'))
+            self.timings.record('vision', time.time() - start, request['robot'], request['last_action'][:1])
+            request['vision'] = {'heading' : heading, 'distance' : distance, 'color' : color}
+            return heading, distance, color
         
     ### CherryPy Server Functions ###
     def __init_tasks__(self):
         if self.VERBOSE: self.pretty_print('CHERRYPY', 'Initializing Monitors ...')
         try:
-            Monitor(cherrypy.engine, self.listen, frequency=self.CHERRYPY_LISTEN_INTERVAL).subscribe()
+            cherrypy.engine.subscribe('start', self.start_listening)
+            cherrypy.engine.subscribe('stop', self.stop_listening)
             Monitor(cherrypy.engine, self.refresh, frequency=self.CHERRYPY_REFRESH_INTERVAL).subscribe()
         except Exception as error:
             self.pretty_print('CHERRYPY', str(error))
+    def start_listening(self):
+        self.listening = True
+        self.listener = threading.Thread(target=self.listen)
+        self.listener.daemon = True
+        self.listener.start()
+    def stop_listening(self):
+        self.listening = False
+        if self.pool is not None:
+            self.pool.close()
     def listen(self):
-        """ Listen for Next Sample """
+        """
+        Serve every robot from one thread: wait on the socket, queue whatever
+        arrived per robot, then answer the queues round-robin so one robot's
+        backlog never holds up the other. Each reply is sent as soon as its
+        decision is made.
+        """
         if self.VERBOSE: self.pretty_print('CHERRYPY', 'Listening for nodes ...')
-        req = self.receive_request()
-        action = self.decide_action(req)
-        resp = self.send_response(action)
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        if self.pool is not None:
+            poller.register(self.pool.done, zmq.POLLIN)
+        while self.listening:
+            try:
+                socks = dict(poller.poll(self.ZMQ_POLL_INTERVAL))
+                if (self.pool is not None) and (socks.get(self.pool.done) == zmq.POLLIN):
+                    self.finish_vision()
+                if socks.get(self.socket) == zmq.POLLIN:
+                    while True:
+                        message = self.receive_request()
+                        if message is None:
+                            break
+                        self.queues.setdefault(message[1]['robot'], collections.deque()).append(message)
+                while any(self.queues.values()):
+                    for (robot, queue) in self.queues.items():
+                        if queue:
+                            (envelope, request) = queue.popleft()
+                            if self.handle_request(envelope, request) is not None:
+                                self.update_stats(robot, request)
+            except Exception as error:
+                self.pretty_print('ZMQ', 'Error: %s' % str(error))
+    def handle_request(self, envelope, request):
+        """ Decide and reply to one request, returns None if the reply waits on the vision pool """
+        self.timings.record('queue', time.time() - request['received'], request['robot'], request['last_action'][:1])
+        with self.lock:
+            last = self.replies.get(self.client_key(request))
+            request_id = self.request_id(request)
+            if (request_id is not None) and (last is not None) and (last['id'] == request_id):
+                return self.answer_retry(envelope, request, last)
+            self.timings.record_robot(request) # once, not again for each retry
+            self.replies[self.client_key(request)] = {'id' : request_id, 'response' : None, 'envelopes' : [envelope]}
+            self.commit_speculation(request)
+            self.commit_batch(request)
+            if request.get('speculative', False):
+                try:
+                    action = self.speculate(request)
+                    response = self.send_response(envelope, action, seq=request.get('seq'), assumed=request['last_action'], frame=self.needs_frame(request['robot'], action))
+                    self.remember(request, response)
+                    self.record(request, response)
+                    return response
+                finally:
+                    self.forget(request)
+            elif self.needs_pool(request):
+                try:
+                    self.submit_vision(envelope, request)
+                except Exception:
+                    self.forget(request)
+                    raise
+            else:
+                return self.reply(envelope, request)
+    def reply(self, envelope, request):
+        """ Decide and reply to a request whose detection is known or found inline """
+        with self.lock:
+            try:
+                start = time.time()
+                action = self.decide_action(request)
+                batch = self.plan_batch(request, action)
+                decided = time.time()
+                fields = {
+                    'seq' : request.get('seq'),
+                    'thumbnail' : self.wants_thumbnail(request),
+                    'frame' : self.needs_frame(request['robot'], (batch or [action])[-1])
+                }
+                if batch:
+                    fields['batch'] = batch
+                    fields['deadline'] = self.clock # abort the batch if the session ends first
+                response = self.send_response(envelope, action, **fields)
+                self.remember(request, response)
+                self.timings.record('decide', decided - start, request['robot'], request['last_action'][:1])
+                self.timings.record('reply', time.time() - decided, request['robot'], request['last_action'][:1])
+                self.record(request, response)
+                return response
+            finally:
+                self.forget(request)
+    def client_key(self, request):
+        """ One robot process, as two clients may run under the same robot name (e.g. the load test) """
+        return request['robot'], request.get('client')
+    def request_id(self, request):
+        """ Robots resend a request with the same client and seq when its response is lost """
+        if request.get('seq') is None:
+            return None # older robots, never treated as retries
+        return request.get('client'), request['seq']
+    def answer_retry(self, envelope, request, last):
+        """
+        Answer a resent request with the response already decided for it, so
+        nothing is decided (or counted) twice. If it is still being decided by
+        the vision pool, the response will also go to this envelope.
+        """
+        self.pretty_print('ZMQ', 'Retry of %s request %d' % (request['robot'], request['seq']))
+        if last['response'] is None:
+            last['envelopes'].append(envelope)
+            return None
+        self.socket.send_multipart(envelope + [json.dumps(last['response'])])
+        return last['response']
+    def remember(self, request, response):
+        """ Keep the response for retries, and send it to those that came in while it was decided """
+        last = self.replies.get(self.client_key(request))
+        if (response is None) or (last is None) or (last['id'] != self.request_id(request)):
+            return
+        last['response'] = response
+        for envelope in last['envelopes'][1:]:
+            self.socket.send_multipart(envelope + [json.dumps(response)])
+        last['envelopes'] = []
+    def forget(self, request):
+        """
+        Drop the entry of a request that failed to be decided or sent, so its
+        next retry is decided afresh instead of waiting on a response that
+        will never come. Does nothing once the response is remembered.
+        """
+        last = self.replies.get(self.client_key(request))
+        if (last is not None) and (last['id'] == self.request_id(request)) and (last['response'] is None):
+            del self.replies[self.client_key(request)]
+    def update_stats(self, robot, request):
+        """ Queue depth and receive-to-reply latency per robot """
+        latency = time.time() - request['received']
+        stats = self.stats.setdefault(robot, {'served' : 0, 'latency' : 0.0, 'mean_latency' : 0.0, 'max_latency' : 0.0})
+        stats['depth'] = len(self.queues[robot])
+        stats['served'] += 1
+        stats['latency'] = latency
+        stats['mean_latency'] += (latency - stats['mean_latency']) / stats['served']
+        stats['max_latency'] = max(stats['max_latency'], latency)
+        self.timings.record('total', latency, robot, request['last_action'][:1])
+    def needs_frame(self, robot, action):
+        """ Whether the request that follows action has to carry a frame """
+        return (robot == 'picker') and (action is not None) and (action[:1] in self.VISION_ACTIONS)
+    def wants_frame(self, request):
+        """ Frames are only decoded for decisions that look at them, or as a thumbnail """
+        return self.needs_frame(request['robot'], request['last_action']) or ('detection' in request)
+    def wants_thumbnail(self, request):
+        """ Ask pickers running their own vision for a GUI thumbnail every so often """
+        if 'detection' not in request or not self.VISION_THUMBNAIL_INTERVAL:
+            return False
+        self.detections_received += 1
+        return (self.detections_received % self.VISION_THUMBNAIL_INTERVAL) == 0
     def refresh(self):
-        """ Update the GUI """
-        self.gui.draw_camera(self.bgr, self.mask)
+        """ Update the GUI and the web feeds """
+        start = time.time()
         picker_position = (0,0) #TODO
         delivery_position = (0,0) #TODO
-        self.gui.draw_board(picker_position, delivery_position)
+        (generation, bgr, mask) = self.frame # set_frame() runs on the listener thread
+        if self.gui is not None:
+            self.gui.draw_camera(bgr, mask, generation)
+            self.gui.draw_board(picker_position, delivery_position)
+        self.feeds['camera'].publish(generation, bgr)
+        self.feeds['mask'].publish(generation, mask)
+        self.feeds['board'].publish((picker_position, delivery_position), self.board)
         if self.running:
             self.clock = self.end_time - time.time()
             if self.clock <= 0:
                 self.running = False
         else:
             self.end_time = time.time() + self.clock         
-        self.gui.update_gui(self.clock)
+        if self.gui is not None:
+            self.gui.update_gui(self.clock)
+        self.timings.record('refresh', time.time() - start)
     @cherrypy.expose
     def index(self):
         """ Render index page """
         html = open('static/index.html').read()
         return html
     @cherrypy.expose
+    def queues_status(self):
+        """ Per-robot queue depth and latency as JSON """
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        stats = {}
+        for (robot, queue) in self.queues.items():
+            stats[robot] = dict(self.stats.get(robot, {}), depth=len(queue))
+        return json.dumps(stats)
+    @cherrypy.expose
+    def metrics(self, format='json'):
+        """
+        Stage timings per robot and action letter, as JSON or with
+        format=prometheus in the Prometheus text format
+        """
+        if format == 'prometheus':
+            cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+            return self.timings.prometheus()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(self.timings.summary())
+    @cherrypy.expose
+    def stream(self, name):
+        """ MJPEG stream of the camera, mask or board, e.g. /stream/camera """
+        if name not in self.feeds:
+            raise cherrypy.NotFound()
+        cherrypy.response.headers['Content-Type'] = mjpeg.CONTENT_TYPE
+        return self.feeds[name].frames()
+    stream._cp_config = {'response.stream': True}
+    @cherrypy.expose
     def default(self, *args, **kwargs):
         """
         Handle Posts -
         This function is basically the RESTful API
+            /run, /stop, /reset : control the session
+            /clock : session state only
+        All return the session state as JSON
         """
+        cherrypy.response.headers['Content-Type'] = 'application/json'
         try:
-            pass
+            command = args[0] if args else 'clock'
+            if command == 'run':
+                self.run(None)
+            elif command == 'stop':
+                self.stop(None)
+            elif command == 'reset':
+                self.reset(None)
+            elif command != 'clock':
+                raise cherrypy.NotFound()
+        except cherrypy.NotFound:
+            raise
         except Exception as err:
             self.pretty_print('ERROR', str(err))
-        return None
+        return json.dumps(self.session_state())
+    def session_state(self):
+        state = dict((key, getattr(self, key)) for key in self.STATE_KEYS)
+        state['running'] = self.running
+        state['clock'] = self.clock
+        return state
+
+    ### Recording ###
+    def __init_recorder__(self):
+        self.recorder = None
+        if self.RECORDER_ON:
+            if self.VERBOSE: self.pretty_print('RECORDER', 'Initializing Recorder ...')
+            try:
+                self.recorder = Recorder(self)
+                cherrypy.engine.subscribe('stop', self.recorder.close)
+            except Exception as error:
+                self.pretty_print('RECORDER', 'Error: %s' % str(error))
+    def record(self, request, response):
+        """ Hand a request and its response to the recorder, with the session state after it """
+        if self.recorder is not None:
+            self.recorder.record(request, response, self.session_state())
+
+    ### Web Feeds ###
+    def __init_streams__(self):
+        if self.VERBOSE: self.pretty_print('CHERRYPY', 'Initializing MJPEG feeds ...')
+        self.board = cv2.imread(self.GUI_BOARD_IMAGE)
+        self.feeds = {
+            'camera' : mjpeg.Feed(self.STREAM_JPEG_QUALITY),
+            'mask' : mjpeg.Feed(self.STREAM_JPEG_QUALITY),
+            'board' : mjpeg.Feed(self.STREAM_JPEG_QUALITY)
+        }
+        cherrypy.engine.subscribe('stop', self.close_streams)
+    def close_streams(self):
+        for feed in self.feeds.values():
+            feed.close()
 
     ### GUI Functions ###
     def __init_gui__(self):
@@ -373,13 +715,16 @@ class Server:
             self.pretty_print('GUI', str(error))
     def run(self, object):
         self.pretty_print("GUI", "Running session ...")
-        self.running = True
+        with self.lock:
+            self.running = True
     def stop(self, object):
         self.pretty_print("GUI", "Halting session ...")
-        self.running = False
+        with self.lock:
+            self.running = False
     def reset(self, object):
         self.pretty_print("GUI", "Resetting to start ...")
-        self.__init_statemachine__() # reset values
+        with self.lock:
+            self.__init_statemachine__() # reset values
     def close(self, widget, window):
         try:
             gtk.main_quit()
@@ -443,10 +788,9 @@ class GUI(object):
             self.label_clock.set(object.GUI_LABEL_CLOCK)
             self.label_clock.show()
             self.vbox2.add(self.label_clock)
-            self.camera_bgr = cv2.imread(object.GUI_CAMERA_IMAGE)
-            self.camera_mask = cv2.imread(object.GUI_MASK_IMAGE)
-            self.camera_pix = gtk.gdk.pixbuf_new_from_array(self.camera_bgr, gtk.gdk.COLORSPACE_RGB, 8)
-            self.camera_pix_mask = gtk.gdk.pixbuf_new_from_array(self.camera_mask, gtk.gdk.COLORSPACE_RGB, 8)
+            self.camera_generation = None # frame generation shown by the camera images
+            self.camera_pix = gtk.gdk.pixbuf_new_from_array(self.to_rgb(cv2.imread(object.GUI_CAMERA_IMAGE)), gtk.gdk.COLORSPACE_RGB, 8)
+            self.camera_pix_mask = gtk.gdk.pixbuf_new_from_array(self.to_rgb(cv2.imread(object.GUI_MASK_IMAGE)), gtk.gdk.COLORSPACE_RGB, 8)
             self.camera_img = gtk.Image()
             self.camera_img_mask = gtk.Image()
             self.camera_img.set_from_pixbuf(self.camera_pix)
@@ -457,9 +801,10 @@ class GUI(object):
             self.vbox2.add(self.camera_img_mask)
             self.vbox.show()
 
-            # Board Image
-            self.board_bgr = cv2.imread(object.GUI_BOARD_IMAGE)
-            self.board_pix = gtk.gdk.pixbuf_new_from_array(self.board_bgr, gtk.gdk.COLORSPACE_RGB, 8)
+            # Board Image (decoded once, redrawn only when a robot moves)
+            self.board_rgb = cv2.cvtColor(cv2.imread(object.GUI_BOARD_IMAGE), cv2.COLOR_BGR2RGB)
+            self.board_positions = None # robot positions drawn on the board image
+            self.board_pix = gtk.gdk.pixbuf_new_from_array(self.board_rgb, gtk.gdk.COLORSPACE_RGB, 8)
             self.board_img = gtk.Image()
             self.board_img.set_from_pixbuf(self.board_pix)
             self.board_img.show()
@@ -476,9 +821,11 @@ class GUI(object):
     
     ## Draw Board
     def draw_board(self, picker_position, delivery_position, x=75, y=132, x_pad=154, y_pad=40, brown=(116,60,12), yellow=(219,199,6), green=(0,255,0), tall=7, short=2):
+        if (picker_position, delivery_position) == self.board_positions:
+            return
         try:
-            board_bgr = cv2.cvtColor(cv2.imread(self.GUI_BOARD_IMAGE), cv2.COLOR_BGR2RGB)
-            (W,H,D) = board_bgr.shape
+            board_rgb = self.board_rgb.copy() # robots are drawn over the static board
+            (W,H,D) = board_rgb.shape
 
             # Picker Robot
             #!TODO
@@ -486,30 +833,38 @@ class GUI(object):
             # Delivery Robot
             #!TODO
 
-            self.board_pix = gtk.gdk.pixbuf_new_from_array(board_bgr, gtk.gdk.COLORSPACE_RGB, 8)
+            self.board_pix = gtk.gdk.pixbuf_new_from_array(board_rgb, gtk.gdk.COLORSPACE_RGB, 8)
             self.board_img.set_from_pixbuf(self.board_pix)
+            self.board_positions = (picker_position, delivery_position)
         except Exception as e:
             print str(e)
 
     ## Draw Camera
-    def draw_camera(self, bgr, mask):
+    def draw_camera(self, bgr, mask, generation):
+        """ Only rebuilds the camera images for a new frame generation """
+        if generation == self.camera_generation:
+            return
         try:
-            self.camera_bgr = cv2.resize(bgr, (320,240))
-            self.camera_mask = cv2.resize(mask, (320,240))
-            rgb = cv2.cvtColor(self.camera_bgr, cv2.COLOR_BGR2RGB)
-            rgb_mask = cv2.cvtColor(self.camera_mask, cv2.COLOR_BGR2RGB)
-            self.camera_pix = gtk.gdk.pixbuf_new_from_array(rgb, gtk.gdk.COLORSPACE_RGB, 8)
-            self.camera_pix_mask = gtk.gdk.pixbuf_new_from_array(rgb_mask, gtk.gdk.COLORSPACE_RGB, 8)
+            self.camera_pix = gtk.gdk.pixbuf_new_from_array(self.to_rgb(bgr), gtk.gdk.COLORSPACE_RGB, 8)
+            self.camera_pix_mask = gtk.gdk.pixbuf_new_from_array(self.to_rgb(mask), gtk.gdk.COLORSPACE_RGB, 8)
             self.camera_img.set_from_pixbuf(self.camera_pix)
             self.camera_img_mask.set_from_pixbuf(self.camera_pix_mask)
+            self.camera_generation = generation
         except Exception as e:
             print str(e)
 
+    ## Convert for display
+    def to_rgb(self, bgr, size=(320,240)):
+        if bgr.shape[1::-1] != size:
+            bgr = cv2.resize(bgr, size)
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
 # Main
 if __name__ == '__main__':
     server = Server(CONFIG_PATH)
     cherrypy.server.socket_host = server.CHERRYPY_ADDR
     cherrypy.server.socket_port = server.CHERRYPY_PORT
+    cherrypy.server.thread_pool = server.CHERRYPY_THREAD_POOL # every stream viewer holds a thread
     currdir = os.path.dirname(os.path.abspath(__file__))
     conf = {
         '/': {'tools.staticdir.on':True, 'tools.staticdir.dir':os.path.join(currdir,server.CHERRYPY_STATIC_DIR)},
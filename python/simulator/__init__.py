@@ -0,0 +1,9 @@
+"""
+Stand-ins for the robots' hardware, to run Robot end to end off the field
+
+    arduino : pseudo-terminal emulator of the Pickup_ECU and Delivery_ECU sketches
+    camera : frames from image directories or video files at a set frame rate
+
+Robot uses them when SIMULATOR_ARDUINO is true and CAMERA_SOURCE is set.
+The modules are imported separately, so the emulator does not load OpenCV.
+"""
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Arduino emulator for the Pickup_ECU and Delivery_ECU sketches
+
+Opens a pseudo-terminal and answers on it the way the sketches answer on
+their serial port: a command letter followed by optional digits, one status
+line per command once the simulated action has taken its time, e.g.
+    {'command':'F','result':0, 'line':0}
+    {'command':'T','result':0,'left':0,'center':0,'right':0}
+Unknown commands are answered at once with ('?', 255).
+
+    python -m simulator.arduino picker
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import os
+import pty
+import select
+import threading
+import time
+import tty
+
+# Constants
+COMMANDS = {
+    'picker' : 'ABCEFGJLORSTWZ',
+    'delivery' : 'ADFGJLORTUWZ'
+}
+VALUE_COMMANDS = {
+    'picker' : 'BFLR', # the value is how long the motors run, in ms
+    'delivery' : '' # the G and O values are ball counts
+}
+STATUS_FORMAT = {
+    'picker' : "{'command':'%c','result':%d, 'line':%d}",
+    'delivery' : "{'command':'%c','result':%d,'left':%d,'center':%d,'right':%d}"
+}
+PARSE_TIMEOUT = 0.02 # as the sketches' Serial.setTimeout()
+
+# Arduino
+class Arduino(object):
+
+    ## Initialize
+    def __init__(self, robot_type, durations, speed=1.0):
+        """
+        robot_type : 'picker' or 'delivery', the sketch to emulate
+        durations : seconds per command letter, with a 'default'; for the
+                    commands that take a duration the value is added in ms
+        speed : durations are divided by this, e.g. 10 runs ten times faster
+        """
+        self.robot_type = robot_type
+        self.commands = COMMANDS[robot_type]
+        self.durations = durations
+        self.speed = speed
+        (self.master, self.slave) = pty.openpty()
+        tty.setraw(self.slave) # no echo or line editing, like a serial port
+        self.port = os.ttyname(self.slave)
+        self.executed = 0
+        self.running = False
+
+    ## Start the emulator thread
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    ## Stop the emulator thread
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    ## Emulator loop
+    def run(self):
+        buffer = ''
+        while self.running:
+            (readable, w, x) = select.select([self.master], [], [], 0.1)
+            if readable:
+                buffer += os.read(self.master, 64)
+            while buffer:
+                (command, value, buffer) = self.read_command(buffer)
+                self.write_status(*self.execute(command, value))
+
+    ## Read a command
+    def read_command(self, buffer):
+        """ As Serial.read() then parseInt(): the letter and the digits after it """
+        (command, rest) = (buffer[0], buffer[1:])
+        while True:
+            digits = len(rest) - len(rest.lstrip('0123456789'))
+            if digits < len(rest):
+                break
+            (readable, w, x) = select.select([self.master], [], [], PARSE_TIMEOUT)
+            if not readable:
+                break
+            rest += os.read(self.master, 64)
+        value = int(rest[:digits]) if digits else 0
+        return command, value, rest[digits:]
+
+    ## Execute a command
+    def execute(self, command, value):
+        """ Takes the command's simulated time, returns (command, result) """
+        if command not in self.commands:
+            return '?', 255
+        duration = self.durations.get(command, self.durations['default'])
+        if command in VALUE_COMMANDS[self.robot_type]:
+            duration += value / 1000.0
+        time.sleep(duration / self.speed)
+        self.executed += 1
+        return command, 0
+
+    ## Write the status line
+    def write_status(self, command, result):
+        if self.robot_type == 'picker':
+            line = STATUS_FORMAT['picker'] % (command, result, 0)
+        else:
+            line = STATUS_FORMAT['delivery'] % (command, result, 0, 0, 0)
+        os.write(self.master, line + '\r\n')
+
+if __name__ == '__main__':
+    import json
+    import sys
+    robot_type = sys.argv[1] if len(sys.argv) > 1 else 'picker'
+    with open('settings.json') as config_file:
+        settings = json.loads(config_file.read())
+    arduino = Arduino(robot_type, settings['SIMULATOR_DURATIONS'][robot_type], settings['SIMULATOR_SPEED']).start()
+    print('Emulating the %s ECU on %s' % (robot_type, arduino.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        arduino.stop()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Camera stand-in for the picker
+
+Serves frames from a directory of images (in file name order) or a video
+file, looping forever, at a set frame rate. It has the grab()/retrieve()
+interface of cv2.VideoCapture that Capture uses, and grab() blocks until
+the next frame is due, as a camera does.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import glob
+import os
+import time
+import cv2
+import numpy as np
+
+# Constants
+IMAGE_PATTERNS = ['*.jpg', '*.jpeg', '*.png']
+
+# Frame Source
+class FrameSource(object):
+
+    ## Initialize
+    def __init__(self, source, width, height, fps=30.0):
+        """
+        source : an image directory or a video file
+        Frames are resized to width x height. Image directories are decoded
+        once, on their first pass.
+        """
+        self.source = source
+        self.size = (width, height)
+        self.interval = 1.0 / fps
+        self.video = None
+        self.paths = []
+        self.images = {} # path -> resized frame
+        if os.path.isdir(source):
+            for pattern in IMAGE_PATTERNS:
+                self.paths.extend(glob.glob(os.path.join(source, pattern)))
+            self.paths.sort()
+            if not self.paths:
+                raise IOError('No images in %s' % source)
+        else:
+            self.video = cv2.VideoCapture(source)
+            if not self.video.isOpened():
+                raise IOError('Cannot open %s' % source)
+        self.index = -1
+        self.frame = None
+        self.due = time.time()
+
+    ## Grab the next frame
+    def grab(self):
+        delay = self.due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.due = max(self.due + self.interval, time.time())
+        if self.video is None:
+            self.index = (self.index + 1) % len(self.paths)
+            path = self.paths[self.index]
+            if path not in self.images:
+                self.images[path] = cv2.resize(cv2.imread(path), self.size)
+            self.frame = self.images[path]
+        else:
+            (s, frame) = self.video.read()
+            if not s: # end of the file, start over
+                self.video.release()
+                self.video = cv2.VideoCapture(self.source)
+                (s, frame) = self.video.read()
+                if not s:
+                    return False
+            self.frame = cv2.resize(frame, self.size)
+        return True
+
+    ## Copy the grabbed frame out
+    def retrieve(self, buf=None):
+        if self.frame is None:
+            return False, None
+        if (buf is not None) and (buf.shape == self.frame.shape):
+            np.copyto(buf, self.frame)
+            return True, buf
+        return True, self.frame.copy()
+
+    ## As cv2.VideoCapture
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+    def set(self, prop, value):
+        return False # there are no camera properties to set
+    def isOpened(self):
+        return True
+    def release(self):
+        if self.video is not None:
+            self.video.release()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Frame-to-frame ball tracking
+
+Each detected ball becomes a track with an ID and a constant-velocity
+Kalman filter over its image position, so a ball can be predicted between
+requests and coasted through a missed detection or two.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import numpy as np
+
+# Constants
+H = np.array([[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0]]) # only position is measured
+
+# Track
+class Track(object):
+
+    ## Initialize
+    def __init__(self, id, x, y, r, color, t, P0, R):
+        self.id = id
+        self.color = color
+        self.r = float(r)
+        self.t = t
+        self.state = np.array([x, y, 0.0, 0.0])
+        self.P = np.diag([R, R, P0, P0])
+        self.hits = 1
+        self.misses = 0
+
+    ## Predict
+    def predict(self, t):
+        """ Returns the predicted (x, y) at time t without changing the track """
+        dt = max(t - self.t, 0.0)
+        return self.state[0] + self.state[2] * dt, self.state[1] + self.state[3] * dt
+
+    ## Propagate to time t
+    def propagate(self, t, Q):
+        dt = max(t - self.t, 0.0)
+        F = np.array([[1.0, 0.0, dt, 0.0], [0.0, 1.0, 0.0, dt], [0.0, 0.0, 1.0, 0.0], [0.0, 0.0, 0.0, 1.0]])
+        self.state = F.dot(self.state)
+        self.P = F.dot(self.P).dot(F.T) + Q * np.diag([dt**2, dt**2, 1.0, 1.0])
+        self.t = t
+
+    ## Correct with a measurement
+    def correct(self, x, y, r, R):
+        z = np.array([x, y])
+        S = H.dot(self.P).dot(H.T) + R * np.eye(2)
+        K = self.P.dot(H.T).dot(np.linalg.inv(S))
+        self.state = self.state + K.dot(z - H.dot(self.state))
+        self.P = (np.eye(4) - K.dot(H)).dot(self.P)
+        self.r = 0.5 * self.r + 0.5 * float(r)
+        self.hits += 1
+        self.misses = 0
+
+# Ball Tracker
+class BallTracker(object):
+
+    ## Initialize
+    def __init__(self, object):
+        """
+        Requires super-object to have the TRACKER_* settings
+        """
+        self.TRACKER_GATE = object.TRACKER_GATE
+        self.TRACKER_MAX_MISSES = object.TRACKER_MAX_MISSES
+        self.TRACKER_PROCESS_NOISE = object.TRACKER_PROCESS_NOISE
+        self.TRACKER_MEASUREMENT_NOISE = object.TRACKER_MEASUREMENT_NOISE
+        self.TRACKER_VELOCITY_NOISE = object.TRACKER_VELOCITY_NOISE
+        self.clear()
+
+    ## Clear all tracks (e.g. once the ball has been grabbed)
+    def clear(self):
+        self.tracks = []
+        self.target = None # ID of the track the robot is approaching
+        self.next_id = 0
+
+    ## Predicted positions of all live tracks
+    def predict(self, t):
+        return [track.predict(t) for track in self.tracks]
+
+    ## Update with the detections of one frame
+    def update(self, detections, t):
+        """
+        detections : [(x, y, r, color)]
+        Associates detections with tracks of the same color by nearest
+        predicted position inside TRACKER_GATE, then starts tracks for the
+        unmatched detections and drops tracks missed too many times.
+        Returns the track ID assigned to each detection.
+        """
+        for track in self.tracks:
+            track.propagate(t, self.TRACKER_PROCESS_NOISE)
+        pairs = []
+        for (i, (x, y, r, color)) in enumerate(detections):
+            for (j, track) in enumerate(self.tracks):
+                if track.color == color:
+                    d = np.hypot(track.state[0] - x, track.state[1] - y)
+                    if d < self.TRACKER_GATE:
+                        pairs.append((d, i, j))
+        pairs.sort()
+        ids = [None] * len(detections)
+        used = set()
+        for (d, i, j) in pairs:
+            if (ids[i] is None) and (j not in used):
+                (x, y, r, color) = detections[i]
+                self.tracks[j].correct(x, y, r, self.TRACKER_MEASUREMENT_NOISE)
+                ids[i] = self.tracks[j].id
+                used.add(j)
+        for (j, track) in enumerate(self.tracks):
+            if j not in used:
+                track.misses += 1
+        for (i, (x, y, r, color)) in enumerate(detections):
+            if ids[i] is None:
+                track = Track(self.next_id, x, y, r, color, t, self.TRACKER_VELOCITY_NOISE, self.TRACKER_MEASUREMENT_NOISE)
+                self.tracks.append(track)
+                ids[i] = track.id
+                self.next_id += 1
+        self.tracks = [kept for kept in self.tracks if kept.misses <= self.TRACKER_MAX_MISSES]
+        return ids
+
+    ## Coast
+    def coast(self):
+        """ The target track if it is still alive but was missed this frame """
+        for track in self.tracks:
+            if (track.id == self.target) and (track.misses > 0) and (track.hits > 1):
+                return track
+        return None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Wire format shared by the Robot and the Server
+
+Requests are sent as ZMQ multipart messages:
+    [header, payload]
+where the header is a small JSON document describing the frame and the
+payload is either the raw BGR buffer or a JPEG encoding of it. The payload
+part is omitted entirely when there is no frame to send.
+
+The original transport (a single JSON document with the frame as nested
+lists under 'bgr') is still accepted so that older robots keep working.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import json
+import time
+import numpy as np
+
+# Constants
+MULTIPART = 'multipart'
+LEGACY = 'json'
+ENCODING_RAW = 'raw'
+ENCODING_JPEG = 'jpeg'
+ENCODINGS = [ENCODING_RAW, ENCODING_JPEG]
+
+## Encode a request
+def encode_request(request, bgr=None, encoding=ENCODING_RAW, quality=90):
+    """
+    Returns the list of message parts for a request dictionary and an
+    optional BGR frame. The request is copied into the header as-is.
+    """
+    header = dict(request)
+    if bgr is None:
+        return [json.dumps(header)]
+    bgr = np.ascontiguousarray(bgr, np.uint8)
+    header['shape'] = list(bgr.shape)
+    header['dtype'] = str(bgr.dtype)
+    header['encoding'] = encoding
+    header.setdefault('timestamp', time.time())
+    if encoding == ENCODING_JPEG:
+        import cv2 # only imported for JPEG, so the delivery robot never loads OpenCV
+        (s, payload) = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not s:
+            raise ValueError('JPEG encoding failed')
+        payload = payload.tostring()
+    elif encoding == ENCODING_RAW:
+        payload = bgr # sent straight from the array's buffer
+    else:
+        raise ValueError('Unrecognized frame encoding: %s' % encoding)
+    return [json.dumps(header), payload]
+
+## Encode a legacy request
+def encode_legacy_request(request, bgr):
+    """ Single JSON document with the frame as nested lists """
+    legacy = dict(request)
+    legacy['bgr'] = np.asarray(bgr).tolist()
+    return [json.dumps(legacy)]
+
+## Decode a request
+def decode_request(parts, wants_frame=None):
+    """
+    Accepts either transport and returns the request dictionary. The frame,
+    if any, is placed under 'bgr' as a numpy array; for raw payloads it is a
+    zero-copy view of the received buffer and is therefore read-only.
+    Parts may be strings or zmq.Frame objects (i.e. recv_multipart(copy=False))
+    wants_frame : optional function of the request; if it returns False the
+                  frame is not decoded and 'bgr' is None
+    """
+    request = json.loads(getattr(parts[0], 'bytes', parts[0]))
+    if 'bgr' in request:
+        request['transport'] = LEGACY
+        wanted = (wants_frame is None) or wants_frame(request)
+        request['bgr'] = np.array(request['bgr'], np.uint8) if wanted else None
+    else:
+        request['transport'] = MULTIPART
+        if (len(parts) > 1) and ((wants_frame is None) or wants_frame(request)):
+            request['bgr'] = decode_frame(request, parts[1])
+    return request
+
+## Decode a frame payload
+def decode_frame(header, payload):
+    encoding = header.get('encoding', ENCODING_RAW)
+    if encoding == ENCODING_RAW:
+        shape = tuple(header['shape'])
+        dtype = np.dtype(str(header.get('dtype', 'uint8')))
+        return np.frombuffer(payload, dtype).reshape(shape)
+    elif encoding == ENCODING_JPEG:
+        import cv2
+        return cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+    else:
+        raise ValueError('Unrecognized frame encoding: %s' % encoding)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+"""
+Ball detection shared by the Server and the Robot
+
+The same pipeline runs either on the server (frames uploaded by the picker)
+or on the picker itself, in which case only the resulting detection is sent.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import time
+import numpy as np
+import cv2, cv
+from tracker import BallTracker
+
+## Match contours to Hough circles
+def match_contours(enclosing, circles, radius_min, radius_max, inclusive=False, max_offset=20):
+    """
+    Pairs the minimum enclosing circles of the contours, i.e. [((x, y), r)],
+    with the Hough circles [(x, y, r)] using one distance matrix.
+    The contour radius gate is exclusive unless inclusive=True, the circle
+    radius gate is always exclusive.
+    Returns:
+        valid : boolean mask of contours passing the radius gate
+        matches : (contour, circle) index pairs, ordered by contour then circle
+    """
+    points = np.array([(x, y, r) for ((x, y), r) in enclosing], np.float64).reshape(-1, 3)
+    radius = points[:, 2]
+    if inclusive:
+        valid = (radius >= radius_min) & (radius <= radius_max)
+    else:
+        valid = (radius > radius_min) & (radius < radius_max)
+    if (circles is None) or (len(circles) == 0) or not valid.any():
+        return valid, []
+    circles = np.asarray(circles)
+    circle_valid = (circles[:, 2] > radius_min) & (circles[:, 2] < radius_max)
+    dx = points[:, 0, np.newaxis] - circles[np.newaxis, :, 0]
+    dy = points[:, 1, np.newaxis] - circles[np.newaxis, :, 1]
+    d = np.sqrt(dx**2 + dy**2)
+    hits = (d < max_offset) & valid[:, np.newaxis] & circle_valid[np.newaxis, :]
+    (rows, cols) = np.nonzero(hits)
+    return valid, zip(rows, cols)
+
+# Color Classifier
+class ColorClassifier(object):
+    """
+    Lookup table from quantized BGR to a bit-field of color classes, so that
+    every color mask comes out of one table gather instead of a full-frame
+    HSV conversion plus one inRange pass per color. With 8 bits per channel
+    the table holds every BGR value and the masks are exactly those of
+    inRange; with fewer, pixels near the bounds take the class of their
+    bin's center, which can change the detected balls.
+    """
+
+    ## Initialize
+    def __init__(self, colors, bits=8):
+        """
+        colors : list of (name, (hue, sat, val) lower, (hue, sat, val) upper),
+                 at most 8 since each color is one bit of the label
+        bits : quantization bits per BGR channel, from 1 to 8 (exact)
+        """
+        if len(colors) > 8:
+            raise ValueError('At most 8 colors are supported')
+        if not (1 <= bits <= 8):
+            raise ValueError('From 1 to 8 bits per channel are supported')
+        self.colors = list(colors)
+        self.bits = bits
+        self.key = (tuple(self.colors), bits)
+        shift = 8 - bits
+        size = 1 << bits
+        levels = np.arange(size)
+        centers = ((levels << shift) + ((1 << shift) >> 1)).astype(np.uint8) # center of each bin
+        (g, r) = np.meshgrid(centers, centers, indexing='ij')
+        self.table = np.zeros(size ** 3, np.uint8)
+        for (k, b) in enumerate(centers): # one blue plane of the cube at a time, to bound the memory used
+            plane = np.dstack((np.full(g.shape, b, np.uint8), g, r))
+            hsv = cv2.cvtColor(plane, cv2.COLOR_BGR2HSV)
+            labels = self.table[k * size * size:(k + 1) * size * size].reshape(size, size)
+            for (i, (name, lower, upper)) in enumerate(self.colors):
+                labels[cv2.inRange(hsv, tuple(lower), tuple(upper)) > 0] |= (1 << i)
+        dtype = np.uint16 if (3 * bits) <= 16 else np.int32 # cv2.LUT has no unsigned 32-bit tables
+        values = np.arange(256) >> shift
+        self.b_index = (values << (2 * bits)).astype(dtype).reshape(1, 256)
+        self.g_index = (values << bits).astype(dtype).reshape(1, 256)
+        self.r_index = values.astype(dtype).reshape(1, 256)
+
+    ## Classify
+    def classify(self, bgr):
+        """ Label image with bit i set where the pixel matches color i """
+        (b, g, r) = cv2.split(bgr)
+        index = cv2.add(cv2.LUT(b, self.b_index), cv2.LUT(g, self.g_index))
+        index = cv2.add(index, cv2.LUT(r, self.r_index))
+        return self.table.take(index)
+
+    ## Masks
+    def masks(self, bgr):
+        """ Dictionary of 0/255 masks, one per color name """
+        labels = self.classify(bgr)
+        masks = {}
+        for (i, (name, lower, upper)) in enumerate(self.colors):
+            masks[name] = cv2.compare(cv2.bitwise_and(labels, 1 << i), 0, cv2.CMP_GT)
+        return masks
+
+# Ball Finder
+class BallFinder(object):
+
+    ## Initialize
+    def __init__(self, object):
+        """
+        Requires super-object to have the GREEN_*, ORANGE_*, CAMERA_*,
+        *_GAIN settings and a pretty_print() function
+        """
+        self.VERBOSE = object.VERBOSE
+        self.CAMERA_WIDTH = object.CAMERA_WIDTH
+        self.CAMERA_HEIGHT = object.CAMERA_HEIGHT
+        self.DISTANCE_GAIN = object.DISTANCE_GAIN
+        self.HEADING_GAIN = object.HEADING_GAIN
+        self.VISION_COLOR_LUT = object.VISION_COLOR_LUT
+        self.VISION_LUT_BITS = object.VISION_LUT_BITS
+        self.VISION_MODE = object.VISION_MODE
+        self.VISION_PYRAMID_LEVELS = object.VISION_PYRAMID_LEVELS
+        self.VISION_ROI_SIZE = object.VISION_ROI_SIZE
+        self.VISION_ROI_MAX = object.VISION_ROI_MAX
+        self.VISION_TRACKER = object.VISION_TRACKER
+        for key in ['HUE_MIN', 'HUE_MAX', 'SAT_MIN', 'SAT_MAX', 'VAL_MIN', 'VAL_MAX', 'ERODE', 'DILATE']:
+            setattr(self, 'GREEN_' + key, getattr(object, 'GREEN_' + key))
+            setattr(self, 'ORANGE_' + key, getattr(object, 'ORANGE_' + key))
+        self.pretty_print = object.pretty_print
+        self.blank = np.zeros((self.CAMERA_HEIGHT, self.CAMERA_WIDTH), np.uint8)
+        self.bgr = None # last annotated frame
+        self.mask = None # last color mask
+        self.classifier = None # built on first use, rebuilt if thresholds change
+        self.last_ball = None # (x, y) of the last confirmed ball, for 'roi' mode
+        self.tracker = BallTracker(object)
+
+    ## Find Ball
+    def find_ball(self, bgr, t=None, RADIUS_MIN=4, RADIUS_MAX=40):
+        """
+        Find the contours for both masks, then use these
+        to compute the minimum enclosing circle and centroid
+        In 'roi' mode the search is first restricted to windows around
+        candidates found on a downscaled copy of the frame, and falls back
+        to the full frame if nothing is confirmed there.
+        With VISION_TRACKER, balls are tracked across frames (t is the
+        capture time) and a briefly missed target is reported at its
+        predicted heading, with no distance so that it is never grabbed.
+        Returns:
+            color : green, yellow
+            pos: heading, distance, color
+        """
+        if t is None:
+            t = time.time()
+        (detected_balls, mask) = self.measure(bgr, self.hints(t), RADIUS_MIN, RADIUS_MAX)
+        return self.select(bgr, mask, detected_balls, t)
+
+    ## Measure
+    def measure(self, bgr, hints=[], RADIUS_MIN=4, RADIUS_MAX=40):
+        """
+        The image half of find_ball, which touches no tracking state and so
+        can run in another process (hints are from hints() of the tracking side)
+        Draws the matched circles on bgr in place.
+        Returns:
+            detected_balls : [(x, y, r, color)]
+            mask : the drawn-on color masks as one BGR image
+        """
+        if self.VERBOSE: self.pretty_print("CV2", "Searching for ball ...")
+        (H, W) = bgr.shape[:2]
+        windows = None
+        if self.VISION_MODE == 'roi':
+            windows = self.search_windows(bgr, RADIUS_MIN, hints)
+        if windows:
+            green_mask = np.zeros((H, W), np.uint8)
+            orange_mask = np.zeros((H, W), np.uint8)
+            detected_balls, circles, marks = [], [], []
+            for (x0, y0, x1, y1) in windows:
+                (g, o, balls, c, m) = self.detect(bgr[y0:y1, x0:x1], RADIUS_MIN, RADIUS_MAX, (x0, y0))
+                green_mask[y0:y1, x0:x1] = g
+                orange_mask[y0:y1, x0:x1] = o
+                detected_balls.extend(balls)
+                circles.extend(c)
+                marks.extend(m)
+        if (not windows) or (len(detected_balls) == 0):
+            (green_mask, orange_mask, detected_balls, circles, marks) = self.detect(bgr, RADIUS_MIN, RADIUS_MAX)
+        return detected_balls, self.draw(bgr, green_mask, orange_mask, detected_balls, circles, marks)
+
+    ## Draw
+    def draw(self, bgr, green_mask, orange_mask, detected_balls, circles, marks):
+        """ Draws the circles and distances on bgr, returns the marked masks as one BGR image """
+        orange_bgr = np.dstack((self.blank, orange_mask, orange_mask)) # set self.mask to be accessed by the GUI
+        green_bgr = np.dstack((self.blank, green_mask, self.blank)) # set self.mask to be accessed by the GUI
+        for ((x2, y2, r2), draw_color) in circles:
+            cv2.circle(bgr, (int(x2), int(y2)), int(r2), draw_color, 2)
+        for (x, y, color) in marks:
+            mask_bgr = green_bgr if color == 'green' else orange_bgr
+            cv2.putText(mask_bgr, 'X', (int(x)-10,int(y)+10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
+        for x,y,r,color in detected_balls:
+            d = self.estimate_distance(y,r)
+            if color == 'green':
+                cv2.putText(bgr, str(d), (int(x)+10, int(y)+10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
+            if color == 'orange':
+                cv2.putText(bgr, str(d), (int(x)+10, int(y)+10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
+        return orange_bgr + green_bgr
+
+    ## Select
+    def select(self, bgr, mask, detected_balls, t):
+        """
+        The tracking half of find_ball: updates the tracks with the
+        detections of the frame captured at t and picks the target
+        Returns:
+            pos: heading, distance, color
+        """
+        if self.VISION_TRACKER:
+            ids = self.tracker.update(detected_balls, t)
+        self.bgr = bgr # set BGR of GUI with the updated, drawn-on version
+        self.mask = mask
+        if len(detected_balls) > 0:
+            color = detected_balls[-1][3] # the color of the last ball drawn, as it always was
+            x,y,r,c = max(detected_balls) # return the farthest to the right, use min() for left
+            cv2.circle(bgr, (int(x),int(y)), 3, (0, 0, 255), -1)
+            if self.VISION_TRACKER:
+                self.tracker.target = ids[detected_balls.index((x,y,r,c))]
+            self.last_ball = (x, y)
+            heading = self.estimate_heading(x)
+            distance = self.estimate_distance(y,r)
+            return heading, distance, color
+        else:
+            self.last_ball = None
+            track = self.tracker.coast() if self.VISION_TRACKER else None
+            if track is not None:
+                (x, y) = track.state[:2]
+                if self.VERBOSE: self.pretty_print("CV2", "Coasting on track %d (%d misses)" % (track.id, track.misses))
+                cv2.circle(bgr, (int(x), int(y)), int(track.r), (128, 128, 128), 2)
+                return self.estimate_heading(x), None, track.color # only a detection in this frame is close enough to grab
+            return None, None, None
+
+    ## Hints
+    def hints(self, t):
+        """ Where balls are expected at time t: the last confirmed ball and the predicted tracks """
+        hints = []
+        if self.last_ball is not None:
+            hints.append(self.last_ball)
+        if self.VISION_TRACKER:
+            hints.extend(self.tracker.predict(t))
+        return hints
+
+    ## Reset Tracks
+    def reset_tracks(self):
+        """ Forget all tracks, e.g. after a ball has been grabbed """
+        self.tracker.clear()
+        self.last_ball = None
+
+    ## Detect
+    def detect(self, bgr, RADIUS_MIN, RADIUS_MAX, offset=(0, 0), blurred=False):
+        """
+        Runs the mask, Hough and contour stages on a frame or a window of it,
+        which is already through blur() if blurred
+        Returns:
+            green_mask, orange_mask : masks of the searched region
+            detected_balls : [(x, y, r, color)]
+            circles : [((x, y, r), draw color)] of the matched Hough circles
+            marks : [(x, y, color)] of contours with no Hough circles at all
+        All coordinates are in the full frame, i.e. shifted by offset
+        """
+        (dx, dy) = offset
+        (green_mask, orange_mask) = self.color_masks(bgr, blurred)
+        detected_balls = []
+        circles = []
+        marks = []
+        orange_circles = self.hough_circles(orange_mask)
+        green_circles = self.hough_circles(green_mask)
+
+        # Green Contours
+        green_enclosing = self.enclosing_circles(green_mask)
+        (valid, matches) = match_contours(green_enclosing, green_circles, RADIUS_MIN, RADIUS_MAX)
+        if green_circles is not None:
+            for (i, j) in matches:
+                ((x, y), radius) = green_enclosing[i]
+                (x2, y2, r2) = green_circles[j]
+                detected_balls.append((x+dx,y+dy,radius,'green'))
+                circles.append(((x2+dx, y2+dy, r2), (0, 255, 0)))
+        else:
+            for i in np.flatnonzero(valid):
+                ((x, y), radius) = green_enclosing[i]
+                marks.append((x+dx, y+dy, 'green'))
+
+        # Orange Contours
+        orange_enclosing = self.enclosing_circles(orange_mask)
+        (valid, matches) = match_contours(orange_enclosing, orange_circles, RADIUS_MIN, RADIUS_MAX, inclusive=True)
+        if orange_circles is not None:
+            for (i, j) in matches:
+                ((x, y), radius) = orange_enclosing[i]
+                (x2, y2, r2) = orange_circles[j]
+                detected_balls.append((x+dx,y+dy,r2,'orange'))
+                circles.append(((x2+dx, y2+dy, r2), (0, 255, 255)))
+        else:
+            for i in np.flatnonzero(valid):
+                ((x, y), radius) = orange_enclosing[i]
+                marks.append((x+dx, y+dy, 'orange'))
+        return green_mask, orange_mask, detected_balls, circles, marks
+
+    ## Search Windows
+    def search_windows(self, bgr, RADIUS_MIN, hints=[]):
+        """
+        Coarse pass on an image pyramid level: every blob of ball color, plus
+        every hinted position inside the frame (see hints()), becomes a
+        window for the full resolution pass.
+        Overlapping windows are merged. Returns None if the windows would not
+        save anything over a full-frame search.
+        """
+        (H, W) = bgr.shape[:2]
+        scale = 2 ** self.VISION_PYRAMID_LEVELS
+        small = bgr
+        for i in range(self.VISION_PYRAMID_LEVELS):
+            small = cv2.pyrDown(small)
+        k = (25 // scale) | 1 # same blur footprint as the full resolution pass
+        blurred = cv2.GaussianBlur(small, (k, k), 0)
+        (green_mask, orange_mask) = self.threshold(blurred)
+        contours = cv2.findContours(cv2.bitwise_or(green_mask, orange_mask), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        centers = []
+        for c in contours:
+            ((x, y), radius) = cv2.minEnclosingCircle(c)
+            if radius * scale >= RADIUS_MIN:
+                centers.append((x * scale, y * scale))
+        centers.extend([(hx, hy) for (hx, hy) in hints if (0 <= hx < W) and (0 <= hy < H)])
+        if len(centers) == 0:
+            return None
+        half = self.VISION_ROI_SIZE // 2 + 12 # pad by the blur radius
+        boxes = [[max(int(cx) - half, 0), max(int(cy) - half, 0), min(int(cx) + half, W), min(int(cy) + half, H)] for (cx, cy) in centers]
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i + 1, len(boxes)):
+                    a, b = boxes[i], boxes[j]
+                    if (a[0] < b[2]) and (b[0] < a[2]) and (a[1] < b[3]) and (b[1] < a[3]):
+                        boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        del boxes[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        area = sum((x1 - x0) * (y1 - y0) for (x0, y0, x1, y1) in boxes)
+        if (len(boxes) > self.VISION_ROI_MAX) or (area > (W * H) / 2):
+            return None
+        return [tuple(box) for box in boxes]
+
+    ## Color Masks
+    def color_masks(self, bgr, blurred=False):
+        """ Blurred (unless it already is), thresholded and cleaned green and orange masks """
+        if not blurred:
+            bgr = self.blur(bgr)
+        (green_mask, orange_mask) = self.threshold(bgr)
+        return self.clean(green_mask, orange_mask)
+    def blur(self, bgr):
+        return cv2.GaussianBlur(bgr, (25, 25), 0)
+    def clean(self, green_mask, orange_mask):
+        """ Erode away specks, then dilate back what is left """
+        green_mask = cv2.erode(green_mask, None, iterations=self.GREEN_ERODE)
+        green_mask = cv2.dilate(green_mask, None, iterations=self.GREEN_DILATE)
+        orange_mask = cv2.erode(orange_mask, None, iterations=self.ORANGE_ERODE)
+        orange_mask = cv2.dilate(orange_mask, None, iterations=self.ORANGE_DILATE)
+        return green_mask, orange_mask
+    def threshold(self, blurred):
+        if self.VISION_COLOR_LUT:
+            masks = self.get_classifier().masks(blurred)
+            return masks['green'], masks['orange']
+        else:
+            (green, orange) = self.color_bounds()
+            hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
+            return cv2.inRange(hsv, green[1], green[2]), cv2.inRange(hsv, orange[1], orange[2])
+    def color_bounds(self):
+        GREEN_LOWER = (self.GREEN_HUE_MIN, self.GREEN_SAT_MIN, self.GREEN_VAL_MIN)
+        GREEN_UPPER = (self.GREEN_HUE_MAX, self.GREEN_SAT_MAX, self.GREEN_VAL_MAX)
+        ORANGE_LOWER = (self.ORANGE_HUE_MIN, self.ORANGE_SAT_MIN, self.ORANGE_VAL_MIN)
+        ORANGE_UPPER = (self.ORANGE_HUE_MAX, self.ORANGE_SAT_MAX, self.ORANGE_VAL_MAX)
+        return [('green', GREEN_LOWER, GREEN_UPPER), ('orange', ORANGE_LOWER, ORANGE_UPPER)]
+    def get_classifier(self):
+        """ The lookup table is only rebuilt when the thresholds change """
+        colors = self.color_bounds()
+        if (self.classifier is None) or (self.classifier.key != (tuple(colors), self.VISION_LUT_BITS)):
+            if self.VERBOSE: self.pretty_print("CV2", "Building color lookup table ...")
+            self.classifier = ColorClassifier(colors, self.VISION_LUT_BITS)
+        return self.classifier
+
+    ## Contours
+    def enclosing_circles(self, mask):
+        """ Minimum enclosing circle ((x, y), r) of every outer contour of the mask """
+        contours = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        return [cv2.minEnclosingCircle(c) for c in contours]
+
+    ## Hough Circles
+    def hough_circles(self, mask):
+        circles = cv2.HoughCircles(mask, cv.CV_HOUGH_GRADIENT, 4.0, 10)
+        if circles is not None:
+            circles = np.round(circles[0, :]).astype("int")
+        return circles
+
+    ## Estimates
+    def estimate_distance(self, y, r):
+        return self.DISTANCE_GAIN * int(2200 * r ** -1.7)
+    def estimate_heading(self, x):
+        return self.HEADING_GAIN * int(x - self.CAMERA_WIDTH / 2)
+
+    ## Thumbnail of the last annotated frame
+    def thumbnail(self, size):
+        if self.bgr is None:
+            return None
+        return cv2.resize(self.bgr, tuple(size), interpolation=cv2.INTER_AREA)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Ball finding in worker processes for the Server
+
+Frames are copied once into shared memory slots (one per worker) and the
+workers run BallFinder.measure() on them in place, so no pixels are
+pickled. Only the detections come back; tracking and the decision stay in
+the server process (see BallFinder.select()). A finished job is announced
+on an inproc ZMQ socket so the server's poll loop wakes up for it.
+"""
+
+__author__ = "Trevor Stanhope"
+__version__ = "0.1"
+
+# Libraries
+import collections
+import multiprocessing
+import time
+import numpy as np
+import zmq
+from vision import BallFinder
+
+# Constants
+DONE_ADDRESS = 'inproc://vision-done'
+
+## Worker process state
+worker = {}
+
+## Settings snapshot
+class Settings(object):
+    """ The upper case settings of the super-object, which can be sent to a worker """
+    def __init__(self, object):
+        for key in dir(object):
+            if key.isupper():
+                setattr(self, key, getattr(object, key))
+    def pretty_print(self, task, msg):
+        print('[%s] %s\t%s' % (time.strftime('%d/%b/%Y:%H:%M:%S'), task, msg))
+
+## Worker initializer
+def init_worker(settings, frames, masks, shape):
+    worker['finder'] = BallFinder(settings)
+    worker['frames'] = [np.frombuffer(frame, np.uint8).reshape(shape) for frame in frames]
+    worker['masks'] = [np.frombuffer(mask, np.uint8).reshape(shape) for mask in masks]
+
+## Worker job
+def measure(slot, hints):
+    """ Returns (slot, detected balls, error) and leaves the drawn frame and mask in the slot """
+    try:
+        (detected_balls, mask) = worker['finder'].measure(worker['frames'][slot], hints)
+        np.copyto(worker['masks'][slot], mask)
+        return slot, detected_balls, None
+    except Exception as error:
+        return slot, [], str(error)
+
+# Vision Pool
+class VisionPool(object):
+
+    ## Initialize
+    def __init__(self, object):
+        """
+        Requires super-object to have the VISION_WORKERS, VISION_POOL_POLICY,
+        VISION_QUEUE_SIZE, VISION_MAX_AGE, CAMERA_* settings, a ZMQ context
+        and a pretty_print() function
+        """
+        self.VERBOSE = object.VERBOSE
+        self.VISION_WORKERS = object.VISION_WORKERS
+        self.VISION_POOL_POLICY = object.VISION_POOL_POLICY
+        self.VISION_QUEUE_SIZE = object.VISION_QUEUE_SIZE
+        self.VISION_MAX_AGE = object.VISION_MAX_AGE
+        self.pretty_print = object.pretty_print
+        self.shape = (object.CAMERA_HEIGHT, object.CAMERA_WIDTH, 3)
+        size = int(np.prod(self.shape))
+        shared_frames = [multiprocessing.RawArray('B', size) for i in range(self.VISION_WORKERS)]
+        shared_masks = [multiprocessing.RawArray('B', size) for i in range(self.VISION_WORKERS)]
+        self.frames = [np.frombuffer(frame, np.uint8).reshape(self.shape) for frame in shared_frames]
+        self.masks = [np.frombuffer(mask, np.uint8).reshape(self.shape) for mask in shared_masks]
+        self.free = range(self.VISION_WORKERS)
+        self.jobs = {} # slot -> job of the frame in it
+        self.pending = collections.deque() # jobs waiting for a free slot
+        self.dropped = 0
+        self.context = object.context
+        self.done = self.context.socket(zmq.PULL)
+        self.done.bind(DONE_ADDRESS)
+        self.notify = None # PUSH end, owned by the pool's result thread
+        self.pool = multiprocessing.Pool(self.VISION_WORKERS, init_worker, (Settings(object), shared_frames, shared_masks, self.shape))
+
+    ## Fits
+    def fits(self, bgr):
+        """ Only frames of the configured camera size fit in the slots """
+        return bgr.shape == self.shape
+
+    ## Submit
+    def submit(self, job, bgr, hints):
+        """
+        Queues a frame for the workers. job is any object handed back by
+        finish(). Returns the jobs dropped to make room, which the caller
+        must answer without a detection (only with the 'drop' policy).
+        """
+        self.pending.append((job, bgr, hints, time.time()))
+        dropped = []
+        if self.VISION_POOL_POLICY == 'drop':
+            while len(self.pending) > self.VISION_QUEUE_SIZE + len(self.free):
+                dropped.append(self.pending.popleft()[0])
+        return dropped + self.dispatch()
+
+    ## Dispatch
+    def dispatch(self):
+        """ Starts pending jobs on free slots, returns the stale jobs dropped on the way """
+        dropped = []
+        while self.free and self.pending:
+            (job, bgr, hints, submitted) = self.pending.popleft()
+            if (self.VISION_POOL_POLICY == 'drop') and (time.time() - submitted > self.VISION_MAX_AGE):
+                dropped.append(job)
+                continue
+            slot = self.free.pop()
+            np.copyto(self.frames[slot], bgr)
+            self.jobs[slot] = job
+            self.pool.apply_async(measure, (slot, hints), callback=self.announce)
+        self.dropped += len(dropped)
+        if dropped and self.VERBOSE:
+            self.pretty_print('POOL', 'Dropped %d stale frames' % len(dropped))
+        return dropped
+
+    ## Announce (runs in the pool's result thread)
+    def announce(self, result):
+        if self.notify is None:
+            self.notify = self.context.socket(zmq.PUSH)
+            self.notify.connect(DONE_ADDRESS)
+        self.notify.send_pyobj(result)
+
+    ## Finish
+    def finish(self):
+        """
+        Takes one finished job off the done socket.
+        Returns (job, bgr, mask, detected_balls, dropped): bgr and mask are
+        copies of the drawn slot, since the slot is given to the next job.
+        """
+        (slot, detected_balls, error) = self.done.recv_pyobj()
+        if error is not None:
+            self.pretty_print('POOL', 'Error: %s' % error)
+        job = self.jobs.pop(slot)
+        bgr = self.frames[slot].copy()
+        mask = self.masks[slot].copy()
+        self.free.append(slot)
+        return job, bgr, mask, detected_balls, self.dispatch()
+
+    ## Close
+    def close(self):
+        self.pool.terminate()
+        self.done.close()
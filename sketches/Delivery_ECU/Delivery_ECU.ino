@@ -29,6 +29,7 @@ const int TURN90_INTERVAL = 2500;
 
 // Serial Commands
 const int BAUD = 9600;
+const int PARSE_TIMEOUT = 20; // ms to wait for the digits of a command value
 const int OUTPUT_LENGTH = 256;
 const int ALIGN_COMMAND         = 'A';
 const int B                     = 'B';
@@ -162,6 +163,7 @@ void setup() {
 
   // USB
   Serial.begin(BAUD);
+  Serial.setTimeout(PARSE_TIMEOUT); // parseInt() would otherwise wait 1 s after every command
 
   // Pins
   pinMode(CENTER_LINE_PIN, INPUT);
@@ -37,6 +37,7 @@ const int SORTING_GATE_DELAY = 500;
 
 // Serial Commands
 const int BAUD = 9600;
+const int PARSE_TIMEOUT = 20; // ms to wait for the digits of a command value
 const int OUTPUT_LENGTH = 256;
 const int ALIGN_COMMAND         = 'A';
 const int BACKUP_COMMAND        = 'B';
@@ -166,6 +167,7 @@ void set_wheel_servos(int fl, int fr, int bl, int br) {
 /* --- Setup --- */
 void setup() {
   Serial.begin(BAUD);
+  Serial.setTimeout(PARSE_TIMEOUT); // parseInt() would otherwise wait 1 s after every command
   pinMode(CENTER_LINE_PIN, INPUT);
   pinMode(RIGHT_LINE_PIN, INPUT);
   pinMode(LEFT_LINE_PIN, INPUT);
@@ -0,0 +1,121 @@
+"""
+Benchmark of the server's ball finder over the bundled camera images
+
+Reports the time spent per stage, the p50/p95/p99 latency of find_ball,
+frames per second and peak memory, and counts the detections per image
+class (the SG, SY, SB, TG, TY and TB file name prefixes). With --output the
+results are also written as JSON, to compare across commits.
+
+    python test/bench_find_ball.py
+    python test/bench_find_ball.py --repeat 5 --output bench.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import resource
+import sys
+import time
+import cv2
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+PYTHON_DIR = os.path.join(TEST_DIR, '..', 'python')
+sys.path.append(PYTHON_DIR)
+from vision import BallFinder
+
+IMAGE_DIRS = ['logitech-525', 'logitech-C270', 'lifecam']
+LABEL = re.compile(r'^(SG|SY|SB|TG|TY|TB)')
+STAGES = ['blur', 'threshold', 'clean', 'hough_circles', 'enclosing_circles', 'draw']
+
+class Settings:
+    def __init__(self, config_path):
+        with open(config_path) as config_file:
+            settings = json.loads(config_file.read())
+            for key in settings:
+                setattr(self, key, settings[key])
+        self.VERBOSE = False
+    def pretty_print(self, task, msg):
+        pass
+
+def timed(timings, name, function):
+    """ Wraps a finder method so every call adds to timings[name] """
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        result = function(*args, **kwargs)
+        timings[name] += time.time() - start
+        return result
+    return wrapper
+
+def label(path):
+    match = LABEL.match(os.path.basename(path))
+    return match.group(1) if match else 'unlabeled'
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+def benchmark(finder, images, repeat):
+    timings = dict((stage, 0.0) for stage in STAGES)
+    for stage in STAGES:
+        setattr(finder, stage, timed(timings, stage, getattr(finder, stage)))
+    latencies = []
+    counts = {}
+    for i in range(repeat):
+        for (path, bgr) in images:
+            frame = bgr.copy()
+            finder.reset_tracks() # the images are not a sequence
+            start = time.time()
+            (heading, distance, color) = finder.find_ball(frame)
+            latencies.append(time.time() - start)
+            if i == 0:
+                count = counts.setdefault(label(path), {'images' : 0, 'green' : 0, 'orange' : 0, 'none' : 0})
+                count['images'] += 1
+                count[color if color is not None else 'none'] += 1
+    frames = len(latencies)
+    total = sum(latencies)
+    return {
+        'frames' : frames,
+        'fps' : frames / total if total > 0 else 0.0,
+        'latency' : {
+            'mean' : total / frames if frames else 0.0,
+            'p50' : percentile(latencies, 50),
+            'p95' : percentile(latencies, 95),
+            'p99' : percentile(latencies, 99)
+        },
+        'stages' : dict((stage, timings[stage] / frames if frames else 0.0) for stage in STAGES),
+        'max_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'detections' : counts
+    }
+
+def report(results):
+    print('%d frames, %.1f fps' % (results['frames'], results['fps']))
+    print('latency ms: mean %.2f, p50 %.2f, p95 %.2f, p99 %.2f' % tuple(1000 * results['latency'][k] for k in ['mean', 'p50', 'p95', 'p99']))
+    for stage in STAGES:
+        print('    %-18s %.2f ms/frame' % (stage, 1000 * results['stages'][stage]))
+    print('peak memory: %d KB' % results['max_rss_kb'])
+    for (name, count) in sorted(results['detections'].items()):
+        print('    %-10s %3d images: %3d green, %3d orange, %3d none' % (name, count['images'], count['green'], count['orange'], count['none']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ball finder on the bundled images')
+    parser.add_argument('--config', default=os.path.join(PYTHON_DIR, 'settings.json'))
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the images')
+    parser.add_argument('--mode', help='override VISION_MODE (full or roi)')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    options = parser.parse_args()
+    settings = Settings(options.config)
+    if options.mode:
+        settings.VISION_MODE = options.mode
+    size = (settings.CAMERA_WIDTH, settings.CAMERA_HEIGHT)
+    images = []
+    for d in IMAGE_DIRS:
+        for path in sorted(glob.glob(os.path.join(TEST_DIR, d, '*.jpg'))):
+            images.append((path, cv2.resize(cv2.imread(path), size)))
+    results = benchmark(BallFinder(settings), images, options.repeat)
+    results['settings'] = dict((key, getattr(settings, key)) for key in ['VISION_MODE', 'VISION_COLOR_LUT', 'VISION_TRACKER', 'CAMERA_WIDTH', 'CAMERA_HEIGHT'])
+    report(results)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=4, sort_keys=True)
@@ -0,0 +1,215 @@
+"""
+Load test of the server's ZMQ endpoint with simulated robots
+
+Runs N picker and delivery clients at a time, in threads or processes,
+each behaving like Robot.run: every action, and every step of a batch,
+takes --think seconds, a batch stops at its deadline, and the client
+reports the last action it executed and uploads a frame from the bundled
+camera images whenever the server asks for one. For each concurrency level
+the throughput, the p50/p95/p99 round trip latency and the requests that
+timed out are reported, overall and per robot type, to find where the
+server saturates. Replies without an action (frames the server dropped as
+stale) are counted apart, and left out of the throughput and latency.
+
+Every client sends its own client id, so the server keeps its retries,
+speculative decisions and batches apart. The server only knows the picker
+and the delivery robot though: all clients of one type share its game
+state (e.g. the ball counts) and its request queue, so N pickers load the
+server like N robots but play one interleaved game, and their latency
+includes waiting behind each other in that queue.
+
+Start the server first. With --control, the session is reset and started
+through the web API before each level, so every level plays the same game.
+
+    python test/bench_server.py --clients 1,2,4,8,16
+    python test/bench_server.py --mode processes --think 0.05 --control http://127.0.0.1:8080 --output load.json
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import urllib2
+import cv2
+import numpy as np
+import zmq
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+PYTHON_DIR = os.path.join(TEST_DIR, '..', 'python')
+sys.path.append(PYTHON_DIR)
+import transport
+
+IMAGE_DIRS = ['logitech-525', 'logitech-C270', 'lifecam']
+FIRST_ACTION = 'Z' # clients start as if just zeroed, and go back to it after '?'
+
+FRAMES = [] # loaded before the clients start, so processes inherit them
+
+def load_frames(size):
+    for d in IMAGE_DIRS:
+        for path in sorted(glob.glob(os.path.join(TEST_DIR, d, '*.jpg'))):
+            FRAMES.append(cv2.resize(cv2.imread(path), size))
+
+def connect(context, addr):
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(addr)
+    return socket
+
+def client(args):
+    """ One simulated robot until the deadline, returns its latencies and counts """
+    (robot, addr, deadline, timeout, encoding, think, seed) = args
+    name = 'bench-%d-%d' % (int(deadline), seed) # unique per client and level, as the server keys retries by it
+    rng = random.Random(seed)
+    blank = np.zeros_like(FRAMES[0])
+    context = zmq.Context()
+    socket = connect(context, addr)
+    result = {'robot' : robot, 'latencies' : [], 'sent' : 0, 'timeouts' : 0, 'dropped' : 0, 'frames' : 0, 'batched' : 0}
+    last_action = FIRST_ACTION
+    send_frame = True
+    completed = None
+    seq = 0
+    while time.time() < deadline:
+        seq += 1
+        request = {'type' : 'request', 'robot' : robot, 'client' : name, 'last_action' : last_action, 'seq' : seq}
+        if completed is not None:
+            (request['batch_seq'], request['completed']) = completed
+            completed = None
+        if send_frame:
+            request['frame_seq'] = seq
+            request['timestamp'] = time.time()
+            bgr = rng.choice(FRAMES) if robot == 'picker' else blank
+            parts = transport.encode_request(request, bgr, encoding)
+            result['frames'] += 1
+        else:
+            parts = transport.encode_request(request)
+        sent = time.time()
+        socket.send_multipart(parts, copy=False)
+        result['sent'] += 1
+        if not socket.poll(timeout):
+            result['timeouts'] += 1
+            socket.close() # a REQ socket cannot send again before it receives
+            socket = connect(context, addr)
+            continue
+        response = json.loads(socket.recv())
+        action = response.get('action')
+        send_frame = response.get('frame', True)
+        if action is None:
+            result['dropped'] += 1
+            continue # the frame was dropped, ask again with a fresh one
+        result['latencies'].append(time.time() - sent)
+        if think:
+            time.sleep(think)
+        batch = response.get('batch', [])
+        if batch:
+            batch_deadline = time.time() + response.get('deadline', 0)
+            executed = 0
+            for step in batch:
+                if time.time() > batch_deadline:
+                    break
+                if think:
+                    time.sleep(think)
+                executed += 1
+            result['batched'] += executed
+            completed = (seq, executed)
+            if executed:
+                action = batch[executed - 1]
+        last_action = action[0] if action != '?' else FIRST_ACTION
+    socket.close()
+    context.term()
+    return result
+
+def control(url, command):
+    urllib2.urlopen('%s/%s' % (url, command)).read()
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+def summarize(latencies):
+    return {
+        'mean' : sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50' : percentile(latencies, 50),
+        'p95' : percentile(latencies, 95),
+        'p99' : percentile(latencies, 99),
+        'max' : latencies[-1] if latencies else 0.0
+    }
+
+def run_level(clients, options):
+    robots = options.robots.split(',')
+    deadline = time.time() + options.duration
+    jobs = [(robots[i % len(robots)], options.addr, deadline, options.timeout, options.encoding, options.think, i) for i in range(clients)]
+    start = time.time()
+    if options.mode == 'processes':
+        pool = multiprocessing.Pool(clients)
+        results = pool.map(client, jobs)
+        pool.close()
+    else:
+        results = [None] * clients
+        def worker(i):
+            results[i] = client(jobs[i])
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    seconds = time.time() - start
+    latencies = sorted(sum([result['latencies'] for result in results], []))
+    per_robot = {}
+    for robot in set(robots):
+        per_robot[robot] = summarize(sorted(sum([result['latencies'] for result in results if result['robot'] == robot], [])))
+    return {
+        'clients' : clients,
+        'seconds' : seconds,
+        'sent' : sum(result['sent'] for result in results),
+        'replies' : len(latencies),
+        'timeouts' : sum(result['timeouts'] for result in results),
+        'dropped' : sum(result['dropped'] for result in results),
+        'frames' : sum(result['frames'] for result in results),
+        'batched' : sum(result['batched'] for result in results),
+        'throughput' : len(latencies) / seconds if seconds > 0 else 0.0,
+        'latency' : summarize(latencies),
+        'robots' : per_robot # latency per robot type
+    }
+
+HEADER = 'clients  replies/s      p50 ms   p95 ms   p99 ms   max ms  timeouts  dropped  frames  batched'
+
+def report(level):
+    latency = level['latency']
+    print('%7d  %9.1f  %9.2f %8.2f %8.2f %8.2f  %8d  %7d  %6d  %7d' % (level['clients'], level['throughput'],
+        1000 * latency['p50'], 1000 * latency['p95'], 1000 * latency['p99'], 1000 * latency['max'],
+        level['timeouts'], level['dropped'], level['frames'], level['batched']))
+    for (robot, latency) in sorted(level['robots'].items()):
+        print('%7s  %9s  %9.2f %8.2f %8.2f %8.2f' % ('', robot, 1000 * latency['p50'], 1000 * latency['p95'], 1000 * latency['p99'], 1000 * latency['max']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the server with simulated robots')
+    parser.add_argument('--config', default=os.path.join(PYTHON_DIR, 'settings.json'))
+    parser.add_argument('--addr', default='tcp://127.0.0.1:1980', help='the server\'s ZMQ endpoint')
+    parser.add_argument('--clients', default='1,2,4,8', help='concurrency levels, comma separated')
+    parser.add_argument('--robots', default='picker,delivery', help='robot types, assigned to the clients in turn')
+    parser.add_argument('--mode', default='threads', choices=['threads', 'processes'])
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per level')
+    parser.add_argument('--timeout', type=int, default=1000, help='ms to wait for a reply before counting a timeout')
+    parser.add_argument('--think', type=float, default=0.0, help='seconds each action or batch step takes to execute')
+    parser.add_argument('--encoding', default=transport.ENCODING_RAW, choices=[transport.ENCODING_RAW, transport.ENCODING_JPEG])
+    parser.add_argument('--control', help='the server\'s web address, to reset and run the session before each level')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    options = parser.parse_args()
+    with open(options.config) as config_file:
+        settings = json.loads(config_file.read())
+    load_frames((settings['CAMERA_WIDTH'], settings['CAMERA_HEIGHT']))
+    levels = []
+    print(HEADER)
+    for clients in [int(n) for n in options.clients.split(',')]:
+        if options.control:
+            control(options.control, 'reset')
+            control(options.control, 'run')
+        levels.append(run_level(clients, options))
+        report(levels[-1])
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(levels, output, indent=4, sort_keys=True)
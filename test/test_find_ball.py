@@ -0,0 +1,95 @@
+"""
+Checks that BallFinder.detect, with its vectorized contour-to-circle
+matching, returns exactly the same detections as the original nested loops
+on the bundled camera images, and that the color lookup table finds the
+same balls as the HSV thresholds.
+
+    python test/test_find_ball.py
+"""
+
+import glob
+import json
+import os
+import sys
+import unittest
+import numpy as np
+import cv2
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+PYTHON_DIR = os.path.join(TEST_DIR, '..', 'python')
+sys.path.append(PYTHON_DIR)
+from vision import BallFinder, match_contours
+
+IMAGE_DIRS = ['logitech-525', 'logitech-C270', 'lifecam']
+RADIUS_MIN = 4
+RADIUS_MAX = 40
+
+class Settings:
+    def __init__(self, config_path):
+        with open(config_path) as config_file:
+            settings = json.loads(config_file.read())
+            for key in settings:
+                setattr(self, key, settings[key])
+        self.VERBOSE = False
+    def pretty_print(self, task, msg):
+        pass
+
+def nested_match(contours, circles, color):
+    """ The matching loops as they were originally written in Server.find_ball """
+    detected_balls = []
+    for c in contours:
+        ((x, y), radius) = cv2.minEnclosingCircle(c)
+        if color == 'green':
+            valid = (radius > RADIUS_MIN) and (radius < RADIUS_MAX)
+        else:
+            valid = (radius >= RADIUS_MIN) and (radius <= RADIUS_MAX)
+        if valid and circles is not None:
+            for (x2,y2,r2) in circles:
+                d = np.sqrt((x - x2)**2 + (y - y2)**2)
+                if (d < 20) and (r2 > RADIUS_MIN) and (r2 < RADIUS_MAX):
+                    if color == 'green':
+                        detected_balls.append((x,y,radius,'green'))
+                    else:
+                        detected_balls.append((x,y,r2,'orange'))
+    return detected_balls
+
+class TestFindBall(unittest.TestCase):
+
+    def setUp(self):
+        self.finder = BallFinder(Settings(os.path.join(PYTHON_DIR, 'settings.json')))
+        self.images = []
+        for d in IMAGE_DIRS:
+            self.images.extend(sorted(glob.glob(os.path.join(TEST_DIR, d, '*.jpg'))))
+
+    def test_images_found(self):
+        self.assertTrue(len(self.images) > 0)
+
+    def test_identical_detections(self):
+        for path in self.images:
+            bgr = cv2.imread(path)
+            (green_mask, orange_mask, detected_balls, circles, marks) = self.finder.detect(bgr, RADIUS_MIN, RADIUS_MAX)
+            expected = []
+            for (color, mask) in [('green', green_mask), ('orange', orange_mask)]:
+                contours = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+                expected.extend(nested_match(contours, self.finder.hough_circles(mask), color))
+            self.assertEqual(expected, detected_balls, os.path.basename(path))
+
+    def test_color_lut(self):
+        size = (self.finder.CAMERA_WIDTH, self.finder.CAMERA_HEIGHT)
+        for path in self.images:
+            bgr = cv2.resize(cv2.imread(path), size)
+            results = []
+            for lut in [False, True]:
+                self.finder.VISION_COLOR_LUT = lut
+                (green_mask, orange_mask, detected_balls, circles, marks) = self.finder.detect(bgr, RADIUS_MIN, RADIUS_MAX)
+                results.append((green_mask.tolist(), orange_mask.tolist(), detected_balls, circles, marks))
+            self.assertEqual(results[0], results[1], os.path.basename(path))
+
+    def test_no_circles(self):
+        contour = np.array([[[10, 10]], [[10, 30]], [[30, 30]], [[30, 10]]], np.int32)
+        (valid, matches) = match_contours([cv2.minEnclosingCircle(contour)], None, RADIUS_MIN, RADIUS_MAX)
+        self.assertEqual(list(valid), [True])
+        self.assertEqual(matches, [])
+
+if __name__ == '__main__':
+    unittest.main()
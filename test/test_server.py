@@ -0,0 +1,77 @@
+"""
+Checks the server's decisions on sequences of picker frames, through the
+same decide_action the ZMQ loop runs, and its answers to retried requests
+(without ZMQ or the GUI).
+
+    python test/test_server.py
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+import numpy as np
+import cv2
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+PYTHON_DIR = os.path.join(TEST_DIR, '..', 'python')
+sys.path.append(PYTHON_DIR)
+from replay import ReplayServer
+
+class Socket:
+    """ Keeps what the server sends instead of sending it """
+    def __init__(self):
+        self.sent = []
+    def send_multipart(self, parts):
+        self.sent.append(parts)
+
+BALL_IMAGE = os.path.join(TEST_DIR, 'logitech-525', '2016-07-10-123417.jpg') # one green ball, out of reach
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.config_path = os.path.join(PYTHON_DIR, 'settings.json')
+
+    def decide(self, server, frames, last_action):
+        """ Decides on each frame in turn, 0.1 s apart """
+        actions = []
+        for (i, bgr) in enumerate(frames):
+            request = {'robot' : 'picker', 'seq' : i, 'last_action' : last_action, 'timestamp' : 0.1 * i, 'bgr' : bgr.copy()}
+            actions.append(server.decide_action(request))
+        return actions
+
+    def test_coasted_track(self):
+        actions = {}
+        for tracker in [False, True]:
+            server = ReplayServer(self.config_path)
+            server.finder.VISION_TRACKER = tracker
+            bgr = cv2.resize(cv2.imread(BALL_IMAGE), (server.CAMERA_WIDTH, server.CAMERA_HEIGHT))
+            actions[tracker] = self.decide(server, [bgr, bgr, np.zeros_like(bgr)], 'L')
+        self.assertEqual(actions[False][:2], actions[True][:2])
+        self.assertEqual(actions[False][2], 'B500') # the ball is lost
+        self.assertNotEqual(actions[True][2], 'B500') # the ball is coasted on
+        self.assertTrue(actions[True][2][0] in ['F', 'L', 'R'])
+
+    def test_retry_after_error(self):
+        server = ReplayServer(self.config_path)
+        server.lock = threading.RLock()
+        server.socket = Socket()
+        server.replies = {}
+        server.recorder = None
+        server.clock = server.RUN_TIME
+        decide_action = server.decide_action
+        def fail_once(request):
+            server.decide_action = decide_action
+            raise RuntimeError('decision failed')
+        server.decide_action = fail_once
+        request = {'type' : 'request', 'robot' : 'picker', 'client' : 'test', 'seq' : 1, 'last_action' : 'Z'}
+        self.assertRaises(RuntimeError, server.handle_request, ['robot'], dict(request, received=time.time()))
+        self.assertEqual(server.socket.sent, [])
+        response = server.handle_request(['robot'], dict(request, received=time.time())) # the robot's retry
+        self.assertEqual(response['action'], 'F5000')
+        self.assertEqual(server.socket.sent, [['robot', json.dumps(response)]])
+
+if __name__ == '__main__':
+    unittest.main()